@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""End-to-end benchmark against the mock API (tamarind.mockserver), no Tamarind account needed.
+For each batch size, times submit, list, monitor, download and aggregate (results.csv), and counts API calls.
+
+    python bench/benchmark.py --sizes 100,1000,10000 --latency 0.02
+"""
+import tamarind.tamarind as tmr
+from tamarind.tamarind import JobManagement
+from tamarind.mockserver import MockServer
+from tamarind.model.alphafold import App
+import pandas as pd
+import argparse as arg
+import os,time,tempfile,shutil
+
+def run(srv, n, output_folder, n_jobs):
+    jm=JobManagement(api_key="mock", base_url=srv.base_url, pool_size=max(n_jobs, tmr.POOL_SIZE), ledger="")
+    batch_name=f"bench{n}"
+    settings={"settings": [{"sequence": "MKTAYIAKQR"*(i%7+1)} for i in range(n)],
+        "jobNames": [f"job{i}" for i in range(n)]}
+    out=[]
+    def stage(name, f):
+        c0=sum(srv.calls.values())
+        t0=time.perf_counter()
+        f()
+        t=time.perf_counter()-t0
+        out.append({'jobs':n, 'stage':name, 'seconds':round(t, 3), 'jobs/s':round(n/t, 1) if t>0 else None, 'api_calls':sum(srv.calls.values())-c0})
+    fd=os.path.join(output_folder, batch_name)
+    stage('submit', lambda: jm.submit_batches(batch_name, "alphafold", settings, n_jobs=n_jobs))
+    stage('list', lambda: jm.get_jobs(expand_batch=True, cache=False))
+    stage('monitor', lambda: jm.monitor_batch(batch_name, skip_download=True))
+    stage('download', lambda: jm.get_batch_results(batch_name, output_folder, n_jobs=n_jobs))
+    stage('aggregate', lambda: App.results(fd))
+    stage('aggregate again', lambda: App.results(fd))
+    stage('delete', lambda: jm.delete_batches([batch_name], n_jobs=n_jobs))
+    return out
+
+def main():
+    opt=arg.ArgumentParser(description='Benchmark submit/monitor/download/aggregate against the mock API')
+    opt.add_argument('--sizes', type=str, default="100,1000", help='Comma-separated batch sizes, e.g., 100,1000,10000,100000')
+    opt.add_argument('--latency', type=float, default=0.0, help='Mean seconds added to each API request')
+    opt.add_argument('--fail', type=float, default=0.0, help='Fraction of API requests answered with 503')
+    opt.add_argument('--run', type=float, nargs=2, default=[0.5, 2], help='Min. and max. seconds a mock job runs')
+    opt.add_argument('-j','--jobs', type=int, default=8, help='Number of parallel requests for submit/download/delete')
+    opt.add_argument('-o','--output', type=str, default=None, help='Save the timings into a .csv file')
+    opt.add_argument('--folder', type=str, default=None, help='Folder for downloaded results, defaults to a temporary folder that is removed')
+    args=opt.parse_args()
+    # the mock is local, no need to be gentle
+    tmr.RATE_LIMIT=0
+    tmr.MONITOR_INTERVAL=1
+    tmr.MIN_INTERVAL=0.5
+    tmr.BACKOFF=0.05
+    tmr.DELETE_RATE=0
+    folder=args.folder or tempfile.mkdtemp(prefix="tmrbench")
+    out=[]
+    try:
+        with MockServer(latency=args.latency, fail_rate=args.fail, queue_time=(0, 0.5), run_time=tuple(args.run)) as srv:
+            for n in [int(x) for x in args.sizes.split(",")]:
+                out.extend(run(srv, n, folder, args.jobs))
+    finally:
+        if args.folder is None: shutil.rmtree(folder, ignore_errors=True)
+    t=pd.DataFrame(out)
+    print(t.to_string(index=False))
+    if args.output is not None:
+        t.to_csv(args.output, index=False)
+
+if __name__=="__main__":
+    main()
@@ -18,6 +18,7 @@ setup(
                       'tqdm',
                       'requests',
                       ],
+    extras_require={'async': ['aiohttp'], 'parquet': ['pyarrow']},
 
     classifiers=[
         'Development Status :: 5 - Production/Stable',
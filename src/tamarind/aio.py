@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""asyncio counterpart of tamarind.tamarind.JobManagement, requires aiohttp (pip install .[async])
+
+    import asyncio
+    from tamarind.aio import AsyncJobManagement
+
+    async def main():
+        async with AsyncJobManagement() as jm:
+            print(await jm.get_jobs())
+            async for job_name, old, new in jm.monitor_batch("mybatch", output_folder="out"):
+                print(job_name, new)
+
+    asyncio.run(main())
+"""
+import aiohttp, asyncio
+import tamarind.tamarind as tmr
+from tamarind.tamarind import Manifest, JobWatcher, PollScheduler
+import pandas as pd
+import os,random,string,time,json,zipfile
+
+# max. number of requests in flight per AsyncJobManagement
+CONCURRENCY=50
+
+class AsyncJobManagement:
+    """Same methods as JobManagement, but they are coroutines, and monitors are async generators.
+    All requests share one aiohttp session, at most concurrency requests are in flight.
+    Connection errors, 429 and 5xx are retried with exponential backoff and jitter.
+    API requests and their retries take tokens from the host-wide rate limiter shared with JobManagement.
+    """
+
+    def __init__(self, api_key=None, base_url=None, concurrency=None, retries=None, timeout=None):
+        """concurrency: defaults to CONCURRENCY
+        base_url, retries, timeout: default to tamarind.tamarind BASE_URL, RETRIES, TIMEOUT
+        """
+        self.api_key = api_key or os.environ.get("TAMARIND_API_KEY", None)
+        if self.api_key is None:
+            print("ERROR> API key not found, please set it with environment variable TAMARIND_API_KEY")
+            exit()
+        self.base_url = base_url = base_url or tmr.BASE_URL
+        self.headers = {'x-api-key': self.api_key}
+        self.retries = tmr.RETRIES if retries is None else retries
+        connect, read = timeout or tmr.TIMEOUT
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        self.concurrency = concurrency or CONCURRENCY
+        self.limiter = tmr.host_limiter(tmr.account_key(self.api_key, base_url))
+        self.session = None
+        self.semaphore = None
+        # batch name -> names of its shards, see batch_shards()
+        self.c_shards = {}
+        # (folder, content hash) -> remote path of files uploaded by this object
+        self.c_uploaded = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        """Create the session, it must be created within the running event loop"""
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            # trust_env picks up http_proxy/https_proxy
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trust_env=True)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _backoff(self, i, headers=None):
+        retry_after = (headers or {}).get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        t = tmr.BACKOFF*(2**i)
+        return random.uniform(t/2, t)
+
+    async def _acquire(self):
+        """Take a rate limiter token, sleep in the event loop while there is none"""
+        while True:
+            t = self.limiter.take()
+            if t<=0: return
+            await asyncio.sleep(t)
+
+    async def _send(self, method, url, data_path=None, **kw):
+        """Send a request with retries, return (status, body bytes)
+        data_path: local file to upload as the request body, it is reopened for each retry
+        """
+        await self.open()
+        for i in range(self.retries+1):
+            headers = None
+            await self._acquire()
+            try:
+                async with self.semaphore:
+                    if data_path is not None:
+                        with open(data_path, 'rb') as f:
+                            async with self.session.request(method, url, data=f, **kw) as r:
+                                status, headers, body = r.status, r.headers, await r.read()
+                    else:
+                        async with self.session.request(method, url, **kw) as r:
+                            status, headers, body = r.status, r.headers, await r.read()
+                if status==429:
+                    # make other clients on this host back off as well, as JobManagement does
+                    self.limiter.pause(tmr.retry_after(headers.get('Retry-After')) or (tmr.MONITOR_INTERVAL if i==self.retries else 0))
+                if status not in tmr.RETRY_STATUS or i==self.retries:
+                    return status, body
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if i==self.retries:
+                    raise
+            await asyncio.sleep(self._backoff(i, headers))
+
+    async def _request(self, method, endpoint, params=None, **kw):
+        """Send an API request, return (status, text)"""
+        if params is not None:
+            # aiohttp only takes str/int/float values
+            params = {k:(str(v).lower() if type(v) is bool else v) for k,v in params.items()}
+        status, body = await self._send(method, self.base_url + endpoint, headers=self.headers, params=params, **kw)
+        return status, body.decode('utf-8', 'ignore')
+
+    async def generate_temp_job_name(self, length=6):
+        """Generate a temporary job name of six characters"""
+        characters = string.ascii_lowercase + string.digits
+        while True:
+            temp_job_name = ''.join(random.choice(characters) for _ in range(length))
+            t = await self.get_jobs(job_name=temp_job_name)
+            if len(t)==0: break
+        return temp_job_name
+
+    async def submit_job(self, job_name, job_type, settings):
+        """Submit a single job"""
+        params = {"jobName": job_name, "type": job_type, "settings": settings}
+        status, text = await self._request("POST", "submit-job", json=params)
+        if tmr.DEBUG: print(text)
+        if status!=200:
+            raise Exception(f"Job {job_name} cannot be created! "+text)
+        return text
+
+    async def submit_batch(self, batch_name, job_type, settings):
+        """Submit a batch containing multiple jobs.
+        Notice batchName and type within settings, if exist, will be overwritten.
+        """
+        settings["batchName"] = batch_name
+        settings["type"] = job_type
+        status, text = await self._request("POST", "submit-batch", json=settings)
+        if tmr.DEBUG: print(text)
+        if status!=200:
+            raise Exception(f"Batch {batch_name} cannot be created! "+text)
+        return text
+
+    async def submit_batches(self, batch_name, job_type, settings, batch_size=None):
+        """Submit a batch in shards of at most batch_size jobs (defaults to BATCH_SIZE) concurrently,
+        shards are named as in JobManagement.submit_batches()
+
+        return list of shard names
+        """
+        batch_size = batch_size or tmr.BATCH_SIZE
+        n = len(settings["jobNames"])
+        S_shard = [tmr.shard_name(batch_name, i) for i in range(max((n+batch_size-1)//batch_size, 1))]
+        self.c_shards[batch_name] = S_shard
+        out = await asyncio.gather(*[self.submit_batch(x, job_type, {**settings,
+                "settings": settings["settings"][i*batch_size:(i+1)*batch_size],
+                "jobNames": settings["jobNames"][i*batch_size:(i+1)*batch_size]})
+            for i,x in enumerate(S_shard)], return_exceptions=True)
+        failed = [(x, e) for x,e in zip(S_shard, out) if isinstance(e, Exception)]
+        if len(failed):
+            raise Exception(f"{len(failed)} of {len(S_shard)} shards of batch {batch_name} cannot be created! "+
+                "; ".join(f"{x}: {e}" for x,e in failed[:3]))
+        return S_shard
+
+    async def upload_file(self, local_filepath, uploaded_filename, folder=None):
+        """Upload a local file to cloud, optionally under a user-specified folder."""
+        params = {}
+        if folder is not None:
+            params["folder"] = folder
+        status, text = await self._request("PUT", f"upload/{uploaded_filename}", params=params, data_path=local_filepath)
+        return status
+
+    async def upload_batch(self, batch_name, S_local_filepath, empty_first=True):
+        """Upload multiple local files into folder [batch_name] (root folder if None) concurrently,
+        identical files are uploaded once, see JobManagement.upload_batch
+        return dict mapping the local file name to the remote file path
+        """
+        S_local = sorted({x for x in S_local_filepath if pd.notnull(x) and x!=''})
+        uploaded = set()
+        if batch_name is not None:
+            if empty_first:
+                await self.delete_batch_files(batch_name)
+                self.c_uploaded = {k:v for k,v in self.c_uploaded.items() if k[0]!=batch_name}
+            else:
+                uploaded = set(await self.get_files(folder=batch_name))
+        # hash in threads, so the event loop is not blocked
+        loop = asyncio.get_running_loop()
+        S_hash = await asyncio.gather(*[loop.run_in_executor(None, tmr.file_hash, x) for x in S_local])
+        c_upload, c_remote, c_todo = tmr.plan_uploads(batch_name, S_local, S_hash, self.c_uploaded, uploaded)
+        S_todo = list(c_todo)
+        S_status = await asyncio.gather(*[self.upload_file(c_todo[x], os.path.basename(x), folder=batch_name) for x in S_todo])
+        failed = [c_todo[x] for x,status in zip(S_todo, S_status) if status//100!=2]
+        if len(failed):
+            raise Exception(f"{len(failed)} files cannot be uploaded: "+", ".join(failed[:5]))
+        for h,full_name in c_remote.items():
+            self.c_uploaded[(batch_name, h)] = full_name
+        if tmr.DEBUG:
+            print("Uploading files: ", c_upload)
+        return c_upload
+
+    async def _pages(self, params):
+        out = []
+        params = dict(params)
+        while True:
+            status, text = await self._request("GET", "jobs", params=params)
+            if status!=200:
+                if tmr.DEBUG: print(text)
+                break
+            jobs_json = json.loads(text)
+            if tmr.DEBUG: print(jobs_json)
+            out.extend(tmr.page_jobs(jobs_json))
+            if 'startKey' not in jobs_json:
+                break
+            params['startKey'] = jobs_json['startKey']
+        return out
+
+    async def get_jobs(self, **kw):
+        """Get a dataframe containing job entries, takes the same arguments as JobManagement.get_jobs()"""
+        opt = {"job_name": None, "expand_batch": False, "organization": False, "job_type": None}
+        opt.update(kw)
+        params = {}
+        if opt['job_name'] is not None:
+            params['jobName'] = opt['job_name']
+        if opt['organization']:
+            params['organization'] = True
+        if opt['expand_batch']:
+            params['includeSubjobs'] = "true"
+        return tmr.jobs_frame(await self._pages(params), opt['job_type'])
+
+    async def batch_shards(self, batch_name, listing=None):
+        """Names of all shards of a batch, see JobManagement.batch_shards()"""
+        if batch_name not in self.c_shards:
+            S_shard = [batch_name]
+            if not tmr.is_shard(batch_name):
+                while True:
+                    x = tmr.shard_name(batch_name, len(S_shard))
+                    if not (x in listing if listing is not None else len(await self.get_jobs(job_name=x))>0):
+                        break
+                    S_shard.append(x)
+            self.c_shards[batch_name] = S_shard
+        return self.c_shards[batch_name]
+
+    async def get_batch_jobs(self, batch_name):
+        """Get all jobs listed under a batch submission, jobs in all its shards are included"""
+        T = await asyncio.gather(*[self.get_shard_jobs(x) for x in await self.batch_shards(batch_name)])
+        return T[0] if len(T)==1 else pd.concat(T, ignore_index=True)
+
+    async def get_shard_jobs(self, batch_name):
+        """Get jobs listed under one submit-batch request"""
+        out = await self._pages({"batch": batch_name})
+        if len(out)==0:
+            print(f"Warning: no job found under batch {batch_name}")
+        return tmr.batch_jobs_frame(out)
+
+    async def delete_job(self, job_name):
+        """Delete a job entry"""
+        status, text = await self._request("POST", "delete-job", json={"jobName": job_name})
+        if tmr.DEBUG: print(text)
+        return text
+
+    async def delete_batch(self, batch_name, listing=None):
+        """Delete all jobs under a batch and all its shards, sub jobs are deleted concurrently
+        listing: names of all top-level jobs, see JobManagement.batch_shards()
+        """
+        S_shard = await self.batch_shards(batch_name, listing)
+        t = await self.get_batch_jobs(batch_name)
+        await asyncio.gather(*[self.delete_batch_files(x) for x in S_shard])
+        await asyncio.gather(*[self.delete_job(x) for x in t.JobName])
+        await asyncio.gather(*[self.delete_job(x) for x in S_shard])
+        self.c_shards.pop(batch_name, None)
+        print(f"Batch deleted: {batch_name}")
+
+    async def delete_all_jobs(self, **kw):
+        """Delete all jobs, kw takes the same values as get_jobs()"""
+        kw['expand_batch'] = False
+        t = await self.get_jobs(**kw)
+        # shards listed along with their batch are deleted with it
+        c_batch = set(t.JobName[t.Type=='batch'])
+        listing = None if kw.get('job_name') is not None else set(t.JobName)
+        await asyncio.gather(*[self.delete_batch(x, listing) if r=='batch' else self.delete_job(x)
+            for x,r in zip(t.JobName, t.Type) if not (r=='batch' and tmr.is_shard(x) and tmr.shard_base(x) in c_batch)])
+        t = await self.get_jobs(**kw)
+        if len(t)==0:
+            print("All jobs have been deleted successfully.")
+            return True
+        print(f"{len(t)} jobs cannot be deleted: "+", ".join(t[:5].JobName.tolist()))
+        return False
+
+    async def get_results(self, job_name, output_folder=".", force=False):
+        """Save job output into output_folder, see JobManagement.get_results()"""
+        manifest = Manifest.open(output_folder)
+        if not force and manifest.is_done(job_name):
+            return f"Skipped, results already in: {os.path.join(output_folder, manifest.get(job_name)['folder'])}"
+        status, text = await self._request("POST", "result", json={"jobName": job_name})
+        if status!=200:
+            if tmr.DEBUG: print(text)
+            return f"Failed to retrieve results URL: {status}"
+        results_url = text.replace('"', '')
+        folder = tmr.job_folder(job_name)
+        fout = os.path.join(output_folder, folder)
+        os.makedirs(fout, exist_ok=True)
+        save_path = os.path.join(fout, "result.zip")
+        headers = {}
+        etag = manifest.get(job_name).get('etag')
+        if not force and etag is not None and os.path.exists(save_path):
+            headers = {'Range': f"bytes={os.path.getsize(save_path)}-", 'If-Range': etag}
+        await self.open()
+        async with self.semaphore:
+            async with self.session.get(results_url, headers=headers) as r:
+                if r.status not in (200, 206):
+                    return f"Failed to download results: {r.status}"
+                manifest.update(job_name, folder=folder, etag=r.headers.get('ETag'), completed=None)
+                with open(save_path, 'ab' if r.status==206 else 'wb') as f:
+                    async for chunk in r.content.iter_chunked(tmr.CHUNK_SIZE):
+                        f.write(chunk)
+        size = os.path.getsize(save_path)
+        # unzip in a thread, so the event loop is not blocked
+        await asyncio.get_running_loop().run_in_executor(None, extract, save_path, fout)
+        manifest.update(job_name, size=size, completed=time.strftime("%Y-%m-%d %H:%M:%S"))
+        return f"Downloaded and unpack results into: {fout}"
+
+    async def download_jobs(self, job_names, output_folder=".", force=False):
+        """Download results of multiple jobs concurrently, return dict mapping failed job names to error messages"""
+        async def one(job_name):
+            try:
+                msg = await self.get_results(job_name, output_folder, force=force)
+                return msg if msg.startswith("Failed") else None
+            except Exception as e:
+                return str(e)
+        out = await asyncio.gather(*[one(x) for x in job_names])
+        return {x:msg for x,msg in zip(job_names, out) if msg is not None}
+
+    async def get_batch_results(self, batch_name, output_folder=".", force=False):
+        """Save all job outputs into output_folder/batch_name, return dict of failed jobs"""
+        t = await self.get_batch_jobs(batch_name)
+        return await self.download_jobs(t.JobName.tolist(), os.path.join(output_folder, batch_name), force=force)
+
+    async def get_files(self, folder=None):
+        """Get a list of files from root, or a specific folder"""
+        params = {} if folder is None else {"folder": folder}
+        status, text = await self._request("GET", "files", params=params)
+        if tmr.DEBUG: print(text)
+        return json.loads(text)
+
+    async def get_all_files(self):
+        """Get a list of all files, including files under folders"""
+        status, text = await self._request("GET", "files", params={"includeFolders": "true"})
+        if tmr.DEBUG: print(text)
+        return json.loads(text)
+
+    async def delete_file(self, file_path):
+        """Delete a specific file"""
+        status, text = await self._request("GET", "delete-file", params={"filePath": file_path})
+        if tmr.DEBUG: print(text)
+        return json.loads(text)
+
+    async def delete_batch_files(self, batch_name):
+        """Delete all files under a folder named batch_name"""
+        status, text = await self._request("GET", "delete-file", params={"folder": batch_name})
+        if tmr.DEBUG: print(text)
+        return json.loads(text)
+
+    async def _wait(self, sched, n_request=1):
+        await asyncio.sleep(sched.next_interval())
+        # the budget is shared with threads, acquire it without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, PollScheduler.budget().acquire, n_request)
+
+    async def monitor(self, job_name, output_folder=".", skip_download=False):
+        """Async generator of the job status, polls till the job finishes, then downloads the results"""
+        sched = PollScheduler()
+        while True:
+            t = await self.get_jobs(job_name=job_name)
+            if len(t)==0:
+                raise Exception(f"Job {job_name} is missing!")
+            sched.update(t.to_dict('records'))
+            status = t.JobStatus.iloc[0]
+            yield status
+            if status=='Complete':
+                if not skip_download:
+                    await self.get_results(job_name, output_folder)
+                break
+            elif status=='Stopped':
+                raise Exception(f"Job {job_name} is stopped!")
+            await self._wait(sched)
+
+    async def _watch(self, watcher, output_folder, skip_download):
+        """Drive a JobWatcher, yield status changes, download completed jobs in the background"""
+        sched = PollScheduler()
+        downloads = []
+        while True:
+            events = []
+            if watcher.is_full_sync():
+                watcher.n_request = 1
+                watcher.apply_listing(await self.get_jobs(job_type=watcher.job_type, expand_batch=watcher.expand_batch), events)
+            else:
+                S_batch, S_job = watcher.active()
+                watcher.n_request = len(S_batch)+len(S_job)
+                T_batch = await asyncio.gather(*[self.get_batch_jobs(x) for x in S_batch])
+                T_job = await asyncio.gather(*[self.get_jobs(job_name=x) for x in S_job])
+                for t in T_batch:
+                    watcher.apply_batch(t, events)
+                for x,t in zip(S_job, T_job):
+                    watcher.apply_job(x, t, events)
+            watcher.n_poll += 1
+            sched.update(watcher.state.values())
+            for job_name, old, new in events:
+                if new=='Complete' and not skip_download:
+                    downloads.append(asyncio.ensure_future(self.get_results(job_name, output_folder)))
+                yield job_name, old, new
+            if watcher.is_done():
+                break
+            await self._wait(sched, watcher.n_request)
+        await asyncio.gather(*downloads)
+
+    async def monitor_all(self, job_type=None, job_names=None, expand_batch=True, output_folder=".", skip_download=False):
+        """Async generator of status changes (job_name, old_status, new_status), see JobManagement.monitor_all()"""
+        watcher = JobWatcher(self, job_type=job_type, job_names=job_names, expand_batch=expand_batch)
+        async for event in self._watch(watcher, output_folder, skip_download):
+            yield event
+
+    async def monitor_batch(self, batch_name, output_folder=".", skip_download=False):
+        """Async generator of status changes (job_name, old_status, new_status) of jobs within a batch,
+        completed jobs are downloaded into output_folder
+        """
+        t = (await self.get_batch_jobs(batch_name)).copy()
+        t['Batch'] = batch_name
+        # seed the watcher with the batch listing, later polls only fetch unfinished jobs of the batch
+        watcher = JobWatcher(self, job_names=t.JobName.tolist(), full_sync=float('inf'))
+        events = []
+        watcher.apply_listing(t, events)
+        watcher.n_poll = 1
+        for event in events:
+            yield event
+        if not skip_download:
+            await self.download_jobs(t[t.JobStatus=='Complete'].JobName.tolist(), output_folder)
+        if not watcher.is_done():
+            async for event in self._watch(watcher, output_folder, skip_download):
+                yield event
+
+def extract(save_path, fout):
+    """Unzip save_path into fout, then remove the archive"""
+    with zipfile.ZipFile(save_path, "r") as zip_file:
+        zip_file.extractall(fout)
+    os.remove(save_path)
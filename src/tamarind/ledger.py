@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Local SQLite record of our jobs, see JobManagement.ledger
+
+Rows are added when jobs/batches are submitted, their status is updated whenever JobManagement
+lists jobs (so monitors keep it current), and get_results() records where results were downloaded.
+Status changes are kept in the events table. Deleted jobs keep their rows, marked deleted, so results
+downloaded before are still found.
+
+    from tamarind.tamarind import JobManagement
+    jm=JobManagement()
+    jm.sync_ledger()
+    print(jm.ledger.frame(status="Running"))
+"""
+import os,time,json,sqlite3,threading,hashlib
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS jobs (account TEXT, name TEXT, type TEXT, model TEXT, batch TEXT, settings_hash TEXT,
+    status TEXT, created TEXT, submitted REAL, updated REAL, finished REAL, folder TEXT, downloaded REAL,
+    sent_hash TEXT, confirmed INTEGER, deleted REAL,
+    PRIMARY KEY (account, name));
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (account, status);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (account, batch);
+CREATE INDEX IF NOT EXISTS jobs_settings ON jobs (account, model, settings_hash);
+CREATE TABLE IF NOT EXISTS events (account TEXT, name TEXT, old TEXT, new TEXT, time REAL);
+CREATE INDEX IF NOT EXISTS events_name ON events (account, name);
+CREATE TABLE IF NOT EXISTS meta (account TEXT, key TEXT, value TEXT, PRIMARY KEY (account, key));
+"""
+# columns added later, for ledger files created before
+MIGRATE=["ALTER TABLE jobs ADD COLUMN sent_hash TEXT", "ALTER TABLE jobs ADD COLUMN confirmed INTEGER", "ALTER TABLE jobs ADD COLUMN deleted REAL"]
+# status of a job submitted by us, but not yet seen in a job listing
+SUBMITTED="Submitted"
+# max. number of ? in one SQL statement
+_CHUNK=500
+
+def settings_hash(settings):
+    """Hash of job settings, independent of the key order"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+class Ledger:
+    """SQLite ledger of jobs under one account, shared by threads (and processes) using the same file.
+    If path is None or the database cannot be opened, all methods do nothing and queries return nothing.
+    """
+
+    def __init__(self, path, account="", final_status=('Complete','Stopped')):
+        self.path=path
+        self.account=account
+        self.final_status=final_status
+        self.lock=threading.Lock()
+        self.db=None
+        if not path: return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db=sqlite3.connect(path, timeout=30, check_same_thread=False)
+            # WAL lets readers in other processes proceed while we write
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+            for sql in MIGRATE:
+                try:
+                    self.db.execute(sql)
+                except sqlite3.OperationalError: # duplicate column
+                    pass
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: job ledger {path} is disabled: {e}")
+            self.db=None
+
+    def _write(self, f):
+        """Run f(db) in one transaction"""
+        if self.db is None: return
+        with self.lock, self.db:
+            return f(self.db)
+
+    def _read(self, sql, args=()):
+        if self.db is None: return []
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def _status(self, db, names):
+        """name -> status of names in the ledger and not deleted"""
+        out={}
+        for i in range(0, len(names), _CHUNK):
+            X=names[i:i+_CHUNK]
+            out.update(db.execute(f"SELECT name,status FROM jobs WHERE account=? AND deleted IS NULL AND name IN ({','.join('?'*len(X))})", [self.account]+X).fetchall())
+        return out
+
+    def _events(self, db, S_event):
+        db.executemany("INSERT INTO events VALUES (?,?,?,?,?)", [(self.account,)+x for x in S_event])
+
+    def submitted(self, names, model, keys=None, batch=None, is_batch=False, replace=False, sent=None):
+        """Record submitted jobs, or a batch entry if is_batch
+        keys: list of settings hashes, one per name, see JobManagement.settings_key()
+        sent: list of settings_hash() of the settings as submitted, one per name. Once a job listing shows a job
+            with these settings (and the batch), its key is confirmed, and find() serves it
+        replace: the names are known to be the new jobs, so existing rows are replaced. Otherwise a row of
+            another batch, or of a finished job, is kept: the server gives a new job in a batch another name
+            if the name is in use (see job_folder()). Rows of deleted jobs are always replaced
+
+        return indices of the names whose rows were kept
+        """
+        now=time.time()
+        keys=keys or [None]*len(names)
+        sent=sent or [None]*len(names)
+        def f(db):
+            kept=[]
+            if not replace:
+                c_old={}
+                for i in range(0, len(names), _CHUNK):
+                    X=names[i:i+_CHUNK]
+                    c_old.update((name, (b, status)) for name,b,status in db.execute(
+                        f"SELECT name,batch,status FROM jobs WHERE account=? AND deleted IS NULL AND name IN ({','.join('?'*len(X))})", [self.account]+X))
+                kept=[i for i,x in enumerate(names) if x in c_old and (c_old[x][0]!=batch or c_old[x][1] in self.final_status)]
+            S_kept=set(kept)
+            rows=[(self.account, x, 'batch' if is_batch else model, model, batch, k, h, SUBMITTED, now, now) for i,(x,k,h) in enumerate(zip(names, keys, sent)) if i not in S_kept]
+            db.executemany("""INSERT INTO jobs (account,name,type,model,batch,settings_hash,sent_hash,status,submitted,updated) VALUES (?,?,?,?,?,?,?,?,?,?)
+                ON CONFLICT (account,name) DO UPDATE SET type=excluded.type, model=excluded.model, batch=excluded.batch,
+                settings_hash=excluded.settings_hash, sent_hash=excluded.sent_hash, confirmed=NULL, status=excluded.status,
+                submitted=excluded.submitted, updated=excluded.updated, finished=NULL, folder=NULL, downloaded=NULL, deleted=NULL""", rows)
+            self._events(db, [(x[1], None, SUBMITTED, now) for x in rows])
+            return kept
+        return self._write(f) or []
+
+    def sync(self, records, batch=None, full=False, expand_batch=False):
+        """Update the ledger with job records returned by the jobs endpoint
+        batch: batch name, if records were listed by batch
+        full: records are a complete listing, jobs missing from it were deleted.
+            Without expand_batch, the listing does not cover jobs within batches
+        A listed job whose row is marked deleted is a new job under a reused name, its row starts over.
+        """
+        now=time.time()
+        rows=[]
+        for r in records:
+            is_batch=r.get('Type')=='batch'
+            model=r.get('Settings') if is_batch else r.get('Type')
+            b=r.get('Batch')
+            b=None if is_batch else (b if isinstance(b, str) and b!='' else batch)
+            s=r.get('Settings')
+            rows.append((self.account, r['JobName'], r.get('Type'), model if isinstance(model, str) else None,
+                b, None if is_batch or not isinstance(s, dict) else settings_hash(s), r.get('JobStatus'), r.get('Created'), now,
+                now if r.get('JobStatus') in self.final_status else None))
+        def f(db):
+            old=self._status(db, [x[1] for x in rows])
+            S_reused=[x[1] for x in rows if x[1] not in old]
+            for i in range(0, len(S_reused), _CHUNK):
+                X=S_reused[i:i+_CHUNK]
+                db.execute(f"""UPDATE jobs SET batch=NULL, settings_hash=NULL, sent_hash=NULL, confirmed=NULL, submitted=NULL, finished=NULL,
+                    folder=NULL, downloaded=NULL, deleted=NULL WHERE account=? AND deleted IS NOT NULL AND name IN ({','.join('?'*len(X))})""", [self.account]+X)
+            # a job listed under another batch, or with other settings, than we submitted is not our job, forget its settings
+            other="(excluded.batch IS NOT NULL AND excluded.batch IS NOT jobs.batch) OR (excluded.sent_hash IS NOT NULL AND excluded.sent_hash IS NOT jobs.sent_hash)"
+            db.executemany(f"""INSERT INTO jobs (account,name,type,model,batch,sent_hash,status,created,updated,finished) VALUES (?,?,?,?,?,?,?,?,?,?)
+                ON CONFLICT (account,name) DO UPDATE SET type=excluded.type, model=COALESCE(excluded.model, jobs.model),
+                settings_hash=CASE WHEN {other} THEN NULL ELSE jobs.settings_hash END,
+                confirmed=CASE WHEN {other} THEN NULL WHEN excluded.sent_hash IS NOT NULL THEN 1 ELSE jobs.confirmed END,
+                sent_hash=COALESCE(excluded.sent_hash, jobs.sent_hash),
+                batch=COALESCE(excluded.batch, jobs.batch), status=excluded.status, created=excluded.created, updated=excluded.updated,
+                finished=CASE WHEN jobs.status=excluded.status THEN jobs.finished ELSE excluded.finished END""", rows)
+            S_event=[(x[1], old.get(x[1]), x[6], now) for x in rows if old.get(x[1])!=x[6]]
+            if full:
+                S_seen={x[1] for x in rows}
+                S_gone=[name for name,status,b in db.execute("SELECT name,status,batch FROM jobs WHERE account=? AND deleted IS NULL", (self.account,))
+                    if name not in S_seen and status!=SUBMITTED and (expand_batch or b is None)]
+                S_event+=self._delete(db, S_gone, now)
+                db.execute("INSERT OR REPLACE INTO meta VALUES (?,?,?)", (self.account, 'full_sync', str(now)))
+            self._events(db, S_event)
+        self._write(f)
+
+    def _delete(self, db, names, now):
+        """Mark rows deleted, they are kept for find()"""
+        old=self._status(db, names)
+        for i in range(0, len(names), _CHUNK):
+            X=names[i:i+_CHUNK]
+            db.execute(f"UPDATE jobs SET deleted=? WHERE account=? AND deleted IS NULL AND name IN ({','.join('?'*len(X))})", [now, self.account]+X)
+        return [(x, old[x], None, now) for x in names if x in old]
+
+    def remove(self, names):
+        """Jobs were deleted, a batch name also removes jobs within the batch"""
+        names=list(names)
+        now=time.time()
+        def f(db):
+            S=names[:]
+            for i in range(0, len(names), _CHUNK):
+                X=names[i:i+_CHUNK]
+                S+=[x for x, in db.execute(f"SELECT name FROM jobs WHERE account=? AND deleted IS NULL AND batch IN ({','.join('?'*len(X))})", [self.account]+X)]
+            self._events(db, self._delete(db, S, now))
+        self._write(f)
+
+    def set_batch_folder(self, batch_names, folder):
+        """Record the output folder of batches and of all jobs within them, whatever the server named the jobs"""
+        batch_names=list(batch_names)
+        def f(db):
+            for i in range(0, len(batch_names), _CHUNK):
+                X=batch_names[i:i+_CHUNK]
+                q=','.join('?'*len(X))
+                db.execute(f"UPDATE jobs SET folder=?, downloaded=NULL WHERE account=? AND (name IN ({q}) OR batch IN ({q}))", [folder, self.account]+X+X)
+        self._write(f)
+
+    def set_folder(self, names, folder, downloaded=False):
+        """Record the output folder of jobs, downloaded: results are now in the folder"""
+        now=time.time()
+        self._write(lambda db: db.executemany("UPDATE jobs SET folder=?, downloaded=? WHERE account=? AND name=?",
+            [(folder, now if downloaded else None, self.account, x) for x in names]))
+
+    def find(self, model, keys, status="Complete"):
+        """Jobs of model in status with the given settings hashes, only those confirmed by a job listing (see submitted()).
+        Deleted jobs are included if their results were downloaded.
+        return dict settings hash -> list of (name, folder, downloaded, deleted), downloaded ones first
+        """
+        out={}
+        keys=list(set(keys))
+        for i in range(0, len(keys), _CHUNK):
+            X=keys[i:i+_CHUNK]
+            for h,name,folder,downloaded,deleted in self._read(f"""SELECT settings_hash,name,folder,downloaded,deleted FROM jobs
+                WHERE account=? AND model=? AND type!='batch' AND status=? AND confirmed=1 AND (deleted IS NULL OR downloaded IS NOT NULL)
+                AND settings_hash IN ({','.join('?'*len(X))}) ORDER BY downloaded IS NULL, finished DESC""", [self.account, model, status]+X):
+                out.setdefault(h, []).append((name, folder, downloaded, deleted))
+        return out
+
+    def last_full_sync(self):
+        """Time of the last complete job listing, None if never"""
+        x=self._read("SELECT value FROM meta WHERE account=? AND key='full_sync'", (self.account,))
+        return float(x[0][0]) if len(x) else None
+
+    def records(self, expand_batch=False, unfinished=False):
+        """Jobs as records shaped like those returned by the jobs endpoint, plus ledger columns
+        (SettingsHash, Submitted, Folder, Downloaded). Without expand_batch, jobs within batches are left out, deleted jobs always.
+        unfinished: only jobs not in a final status
+        """
+        sql="SELECT name,status,type,model,batch,created,settings_hash,submitted,folder,downloaded FROM jobs WHERE account=? AND deleted IS NULL"
+        if not expand_batch: sql+=" AND batch IS NULL"
+        if unfinished: sql+=f" AND status NOT IN ({','.join('?'*len(self.final_status))})"
+        out=[]
+        for name,status,type,model,batch,created,h,submitted,folder,downloaded in self._read(sql, (self.account,)+(tuple(self.final_status) if unfinished else ())):
+            r={'JobName':name, 'JobStatus':status, 'Type':type, 'Settings':model if type=='batch' else None, 'Created':created,
+                'SettingsHash':h, 'Submitted':submitted, 'Folder':folder, 'Downloaded':downloaded}
+            if batch is not None: r['Batch']=batch
+            out.append(r)
+        return out
+
+    def frame(self, expand_batch=True, status=None):
+        """Dataframe of jobs, status: restricted to this status"""
+        import pandas as pd
+        t=pd.DataFrame(self.records(expand_batch), columns=['JobName','JobStatus','Type','Settings','Created','Batch','SettingsHash','Submitted','Folder','Downloaded'])
+        return t if status is None else t[t.JobStatus==status].copy()
+
+    def events(self, job_name=None):
+        """Dataframe of status changes, old status None: first seen, new status None: deleted"""
+        import pandas as pd
+        sql="SELECT name,old,new,time FROM events WHERE account=?"
+        args=(self.account,)
+        if job_name is not None:
+            sql+=" AND name=?"
+            args+=(job_name,)
+        t=pd.DataFrame(self._read(sql+" ORDER BY time", args), columns=['JobName','Old','New','Time'])
+        t['Time']=pd.to_datetime(t.Time, unit='s')
+        return t
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Instrumentation of API calls made by JobManagement: endpoint, status, latency, bytes in/out, retries,
+and time spent waiting for the rate limiter. Enabled by tamarind.tamarind.METRICS (environment variable
+TAMARIND_METRICS), a comma-separated list of sinks:
+
+    summary             latency histogram per endpoint, printed at exit
+    jsonl:calls.jsonl   one JSON line per call
+    prom:tamarind.prom  Prometheus text file (e.g., for the node_exporter textfile collector),
+                        rewritten every PROM_INTERVAL seconds and at exit
+
+    export TAMARIND_METRICS=summary,jsonl:/tmp/tmr_calls.jsonl
+"""
+import os,time,json,threading,atexit,random,math
+
+# upper bounds (seconds) of latency histogram buckets
+BUCKETS=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+# latencies kept per endpoint to compute percentiles, a random sample is kept beyond that
+SAMPLE_SIZE=10000
+# seconds between rewrites of the Prometheus file
+PROM_INTERVAL=10
+
+class Histogram:
+    """In-memory statistics per endpoint"""
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        # endpoint -> dict of counters
+        self.data={}
+
+    def add(self, e):
+        with self.lock:
+            x=self.data.get(e['endpoint'])
+            if x is None:
+                x=self.data[e['endpoint']]={'count':0, 'errors':0, 'seconds':0.0, 'wait':0.0, 'bytes_in':0, 'bytes_out':0,
+                    'retries':0, 'buckets':[0]*len(BUCKETS), 'sample':[], 'status':{}}
+            x['count']+=1
+            x['errors']+=not (200<=e['status']<300)
+            x['seconds']+=e['seconds']
+            x['wait']+=e.get('wait', 0)
+            x['bytes_in']+=e.get('bytes_in', 0)
+            x['bytes_out']+=e.get('bytes_out', 0)
+            x['retries']+=e.get('retries', 0)
+            x['status'][e['status']]=x['status'].get(e['status'], 0)+1
+            for i,b in enumerate(BUCKETS):
+                if e['seconds']<=b:
+                    x['buckets'][i]+=1
+                    break
+            # reservoir sampling, so memory stays bounded
+            if len(x['sample'])<SAMPLE_SIZE:
+                x['sample'].append(e['seconds'])
+            else:
+                i=random.randrange(x['count'])
+                if i<SAMPLE_SIZE: x['sample'][i]=e['seconds']
+
+    def summary(self):
+        """Dataframe with one row per endpoint"""
+        import pandas as pd
+        out=[]
+        with self.lock:
+            for k,x in sorted(self.data.items()):
+                S=pd.Series(x['sample'])
+                out.append({'endpoint':k, 'calls':x['count'], 'errors':x['errors'], 'retries':x['retries'],
+                    'p50':S.quantile(0.5), 'p95':S.quantile(0.95), 'max':S.max(), 'total_s':x['seconds'],
+                    'wait_s':x['wait'], 'MB_in':x['bytes_in']/1e6, 'MB_out':x['bytes_out']/1e6})
+        return pd.DataFrame(out)
+
+    def close(self):
+        if len(self.data)==0: return
+        print("API calls:")
+        print(self.summary().to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+class PromSink(Histogram):
+    """Histogram exported as a Prometheus text file, written atomically"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path=path
+        self.last=0
+
+    def add(self, e):
+        super().add(e)
+        if time.time()-self.last>PROM_INTERVAL:
+            self.write()
+
+    def write(self):
+        self.last=time.time()
+        S=["# TYPE tamarind_request_seconds histogram"]
+        with self.lock:
+            for k,x in sorted(self.data.items()):
+                n=0
+                for b,c in zip(BUCKETS, x['buckets']):
+                    n+=c
+                    S.append(f'tamarind_request_seconds_bucket{{endpoint="{k}",le="{"+Inf" if b==math.inf else b}"}} {n}')
+                S.append(f'tamarind_request_seconds_sum{{endpoint="{k}"}} {x["seconds"]}')
+                S.append(f'tamarind_request_seconds_count{{endpoint="{k}"}} {x["count"]}')
+            S.append("# TYPE tamarind_requests_total counter")
+            for k,x in sorted(self.data.items()):
+                for status,c in sorted(x['status'].items()):
+                    S.append(f'tamarind_requests_total{{endpoint="{k}",status="{status}"}} {c}')
+            for name in ("retries", "bytes_in", "bytes_out"):
+                S.append(f"# TYPE tamarind_{name}_total counter")
+                for k,x in sorted(self.data.items()):
+                    S.append(f'tamarind_{name}_total{{endpoint="{k}"}} {x[name]}')
+        tmp=self.path+f".{os.getpid()}"
+        with open(tmp, 'w') as f:
+            f.write("\n".join(S)+"\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if len(self.data): self.write()
+
+class JsonlSink:
+    """One JSON line per call"""
+
+    def __init__(self, path):
+        self.lock=threading.Lock()
+        self.f=open(path, 'a', buffering=1)
+
+    def add(self, e):
+        with self.lock:
+            self.f.write(json.dumps(e)+"\n")
+
+    def close(self):
+        self.f.close()
+
+class Metrics:
+    """Pass an event per API call to the sinks, sinks are closed at exit"""
+
+    def __init__(self, sinks=None):
+        self.sinks=sinks or []
+        atexit.register(self.close)
+
+    def __bool__(self):
+        return len(self.sinks)>0
+
+    def record(self, endpoint, status, seconds, **kw):
+        """kw: bytes_in, bytes_out, retries, wait"""
+        e={'time':time.time(), 'endpoint':endpoint, 'status':status, 'seconds':seconds, **kw}
+        for x in self.sinks:
+            x.add(e)
+
+    def summary(self):
+        """Dataframe from the first histogram sink, None if there is none"""
+        for x in self.sinks:
+            if isinstance(x, Histogram): return x.summary()
+        return None
+
+    def close(self):
+        for x in self.sinks:
+            x.close()
+        self.sinks=[]
+
+_cache={}
+_lock=threading.Lock()
+
+def get_metrics(spec):
+    """Metrics for a sink specification (see module doc), shared within the process,
+    so the summary at exit covers all JobManagement objects
+    """
+    with _lock:
+        if spec not in _cache:
+            sinks=[]
+            for x in (spec or "").split(","):
+                kind,_,path=x.strip().partition(":")
+                if kind=="": continue
+                if kind=="summary":
+                    sinks.append(Histogram())
+                elif kind=="jsonl":
+                    sinks.append(JsonlSink(path or "tamarind_calls.jsonl"))
+                elif kind=="prom":
+                    sinks.append(PromSink(path or "tamarind.prom"))
+                else:
+                    print(f"Warning: unknown metrics sink {kind}, expect summary, jsonl:<file> or prom:<file>")
+            _cache[spec]=Metrics(sinks)
+        return _cache[spec]
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Local stand-in for the Tamarind API, for development and benchmarks without an account.
+Jobs live in memory and go through In Queue -> Running -> Complete (or Stopped), result archives
+contain a metrics file in the layout of the model (alphafold, boltz, intfold) plus dummy structures.
+Latency, failures (503) and a rate limit (429 with Retry-After) can be injected.
+
+    python -m tamarind.mockserver --port 8000 --latency 0.05 --fail 0.01
+    export TAMARIND_API_KEY=mock TAMARIND_BASE_URL=http://127.0.0.1:8000/api/
+    tmrmonitor -l
+
+or within Python:
+
+    from tamarind.mockserver import MockServer
+    with MockServer(run_time=(1, 5)) as srv:
+        jm=JobManagement(api_key="mock", base_url=srv.base_url)
+"""
+import http.server, threading, io, zipfile, json, time, random, hashlib
+from collections import Counter
+import argparse as arg
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+class MockState:
+    """Jobs, batches and files of the mock account, thread-safe"""
+
+    def __init__(self, queue_time=(0, 1), run_time=(1, 5), stop_rate=0.0, page_size=1000, structure_size=2000, seed=0):
+        """queue_time, run_time: (min, max) seconds a job stays In Queue, then Running
+        stop_rate: fraction of jobs that end up Stopped instead of Complete
+        page_size: job records per page of the jobs endpoint, further pages are fetched with startKey
+        structure_size: bytes of each dummy structure file in a result archive
+        """
+        self.queue_time=queue_time
+        self.run_time=run_time
+        self.stop_rate=stop_rate
+        self.page_size=page_size
+        self.structure_size=structure_size
+        self.rng=random.Random(seed)
+        self.lock=threading.Lock()
+        # job name -> dict(JobName, Type, Settings, Created, Batch, t_start, t_end, stopped)
+        self.jobs={}
+        # batch name -> names of its jobs
+        self.members={}
+        # file path -> size
+        self.files={}
+
+    def add_job(self, name, job_type, settings, batch=None):
+        now=time.time()
+        t_start=now+self.rng.uniform(*self.queue_time)
+        self.jobs[name]={'JobName':name, 'Type':job_type, 'Settings':settings, 'Batch':batch,
+            'Created':time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now)),
+            't_start':t_start, 't_end':t_start+self.rng.uniform(*self.run_time), 'stopped':self.rng.random()<self.stop_rate}
+        if batch is not None: self.members[batch].append(name)
+
+    def status(self, x, now):
+        if x['Type']=='batch':
+            S=[self.status(self.jobs[y], now) for y in self.members.get(x['JobName'], [])]
+            return 'Complete' if all(s in ('Complete', 'Stopped') for s in S) else 'Running'
+        if now<x['t_start']: return 'In Queue'
+        if now<x['t_end']: return 'Running'
+        return 'Stopped' if x['stopped'] else 'Complete'
+
+    def record(self, x, now, with_batch=False):
+        r={'JobName':x['JobName'], 'JobStatus':self.status(x, now), 'Type':x['Type'], 'Settings':x['Settings'], 'Created':x['Created'], 'Score':None}
+        if with_batch and x['Batch'] is not None: r['Batch']=x['Batch']
+        return r
+
+    def list_jobs(self, q):
+        """Response of the jobs endpoint"""
+        now=time.time()
+        with self.lock:
+            if 'jobName' in q:
+                x=self.jobs.get(q['jobName'])
+                return {} if x is None else {'0': self.record(x, now)}
+            if 'batch' in q:
+                S=[self.record(self.jobs[x], now, True) for x in self.members.get(q['batch'], [])]
+            else:
+                expand=q.get('includeSubjobs')=="true"
+                S=[self.record(x, now, expand) for x in self.jobs.values() if expand or x['Batch'] is None]
+        i=int(q.get('startKey', 0))
+        out={'jobs': S[i:i+self.page_size]}
+        if i+self.page_size<len(S): out['startKey']=str(i+self.page_size)
+        return out
+
+    def submit_job(self, body):
+        with self.lock:
+            if body.get('jobName') in self.jobs: return 400, f"Job {body.get('jobName')} already exists"
+            self.add_job(body['jobName'], body['type'], body.get('settings'))
+        return 200, "Job submitted"
+
+    def submit_batch(self, body):
+        name=body.get('batchName')
+        with self.lock:
+            if name in self.jobs: return 400, f"Batch {name} already exists"
+            if len(body.get('settings', []))!=len(body.get('jobNames', [])): return 400, "settings and jobNames differ in length"
+            self.add_job(name, 'batch', body['type'])
+            self.members[name]=[]
+            for x,s in zip(body['jobNames'], body['settings']):
+                # like Tamarind, a name used before is prefixed by the batch name
+                self.add_job(f"{name}-{x}" if x in self.jobs else x, body['type'], s, batch=name)
+        return 200, "Batch submitted"
+
+    def delete_job(self, name):
+        with self.lock:
+            x=self.jobs.pop(name, None)
+            if x is None: return 400, f"Job {name} not found"
+            if x['Batch'] is not None:
+                self.members[x['Batch']].remove(name)
+            for k in self.members.pop(name, []):
+                del self.jobs[k]
+        return 200, "Job deleted"
+
+    def result_zip(self, name):
+        """Result archive of a completed job, None if there is none"""
+        with self.lock:
+            x=self.jobs.get(name)
+            if x is None or self.status(x, time.time())!='Complete': return None
+            job_type=x['Type']
+        pad="ATOM\n"*(self.structure_size//5)
+        S_pdb=[f"{name}_model_{i}.pdb" for i in range(1, 6)]
+        score=[round(1-i/10, 2) for i in range(5)]
+        if job_type=='boltz':
+            fn, t="metrics.csv", "pdb_filepath,iptm\n"+"".join(f"{p},{s}\n" for p,s in zip(S_pdb, score))
+        elif job_type=='intfold':
+            fn, t="result.csv", "filename,ranking_score\n"+"".join(f"{p},{s}\n" for p,s in zip(S_pdb, score))
+        else:
+            fn, t="metrics.csv", "Rank,Pdb Path,plddt\n"+"".join(f"{i+1},{p},{s*100}\n" for i,(p,s) in enumerate(zip(S_pdb, score)))
+        b=io.BytesIO()
+        with zipfile.ZipFile(b, 'w') as z:
+            z.writestr(fn, t)
+            for p in S_pdb:
+                z.writestr(p, pad)
+        return b.getvalue()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def log_message(self, *a):
+        pass
+
+    def _send(self, code, body, headers=None):
+        if not isinstance(body, (str, bytes)): body=json.dumps(body)
+        if isinstance(body, str): body=body.encode()
+        self.send_response(code)
+        for k,v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject(self):
+        """Latency, rate limit and random failures, return True if the request was answered"""
+        srv=self.server
+        if srv.latency>0:
+            time.sleep(srv.rng.uniform(srv.latency/2, srv.latency*1.5))
+        if srv.rate_limit>0:
+            with srv.lock:
+                now=time.time()
+                srv.tokens=min(srv.rate_limit, srv.tokens+(now-srv.last)*srv.rate_limit)
+                srv.last=now
+                ok=srv.tokens>=1
+                if ok: srv.tokens-=1
+            if not ok:
+                self._send(429, "Too Many Requests", {'Retry-After': '1'})
+                return True
+        if srv.fail_rate>0 and srv.rng.random()<srv.fail_rate:
+            self._send(503, "Service Unavailable")
+            return True
+        return False
+
+    def _handle(self, method):
+        u=urlparse(self.path)
+        q={k:v[0] for k,v in parse_qs(u.query).items()}
+        n=int(self.headers.get('Content-Length', 0))
+        data=self.rfile.read(n) if n else b''
+        state=self.server.state
+        with self.server.lock:
+            self.server.calls[u.path.split("/")[2] if u.path.startswith("/api/") else "download"]+=1
+        if u.path.startswith("/download/"):
+            return self._download(unquote(u.path[len("/download/"):]))
+        if not u.path.startswith("/api/"):
+            return self._send(404, "Not Found")
+        if self.headers.get('x-api-key') is None:
+            return self._send(401, "Missing API key")
+        if self._inject(): return
+        endpoint=u.path[len("/api/"):]
+        body=json.loads(data) if method=="POST" and data else {}
+        if method=="GET" and endpoint=="jobs":
+            out=state.list_jobs(q)
+            return self._send(200 if len(out) else 404, out if len(out) else "No job found")
+        if method=="POST" and endpoint=="submit-job":
+            return self._send(*state.submit_job(body))
+        if method=="POST" and endpoint=="submit-batch":
+            return self._send(*state.submit_batch(body))
+        if method=="POST" and endpoint=="delete-job":
+            return self._send(*state.delete_job(body.get('jobName')))
+        if method=="POST" and endpoint=="result":
+            name=body.get('jobName')
+            with state.lock:
+                x=state.jobs.get(name)
+                ok=x is not None and state.status(x, time.time())=='Complete'
+            if not ok: return self._send(400, f"No results for {name}")
+            # signed URL, served by the same server
+            sig=hashlib.sha1(name.encode()).hexdigest()[:8]
+            return self._send(200, json.dumps(f"http://{self.server.host}:{self.server.server_port}/download/{quote(name)}?sig={sig}"))
+        if method=="PUT" and endpoint.startswith("upload/"):
+            path="/".join(x for x in (q.get('folder'), endpoint[len("upload/"):]) if x)
+            with state.lock:
+                state.files[path]=len(data)
+            return self._send(200, "File uploaded")
+        if method=="GET" and endpoint=="files":
+            with state.lock:
+                S=sorted(state.files)
+            if q.get('includeFolders')=="true":
+                return self._send(200, S+sorted({x.split("/")[0]+"/" for x in S if "/" in x}))
+            folder=q.get('folder')
+            return self._send(200, [x for x in S if (x.rsplit("/", 1)[0] if "/" in x else None)==folder])
+        if method=="GET" and endpoint=="delete-file":
+            with state.lock:
+                if 'folder' in q:
+                    S=[x for x in state.files if x.startswith(q['folder']+"/")]
+                else:
+                    S=[x for x in state.files if x==q.get('filePath')]
+                for x in S:
+                    del state.files[x]
+            return self._send(200, {"deleted": S})
+        self._send(404, "Not Found")
+
+    def _download(self, name):
+        data=self.server.state.result_zip(name)
+        if data is None:
+            return self._send(404, "Not Found")
+        etag='"'+hashlib.md5(data).hexdigest()+'"'
+        rg=self.headers.get('Range')
+        if rg and self.headers.get('If-Range') in (None, etag) and rg.startswith("bytes="):
+            start=int(rg[len("bytes="):].split("-")[0])
+            return self._send(206, data[start:], {'ETag': etag, 'Content-Range': f"bytes {start}-{len(data)-1}/{len(data)}"})
+        self._send(200, data, {'ETag': etag})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """Mock API on host:port (port 0 picks a free one), served from a background thread by start()
+    latency: mean seconds added to every API request
+    fail_rate: fraction of API requests answered with 503
+    rate_limit: API requests per second, beyond that 429 is returned, 0 means no limit
+    Other arguments are passed to MockState.
+    """
+    daemon_threads=True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0, rate_limit=0, seed=0, **kw):
+        super().__init__((host, port), Handler)
+        self.host=host
+        self.state=MockState(seed=seed, **kw)
+        self.latency=latency
+        self.fail_rate=fail_rate
+        self.rate_limit=rate_limit
+        self.tokens=rate_limit
+        self.last=time.time()
+        self.rng=random.Random(seed)
+        self.lock=threading.Lock()
+        # endpoint -> number of requests
+        self.calls=Counter()
+        self.thread=None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.server_port}/api/"
+
+    def start(self):
+        self.thread=threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *a):
+        self.stop()
+
+def main():
+    opt=arg.ArgumentParser(description='Mock Tamarind API server')
+    opt.add_argument('--host', type=str, default="127.0.0.1")
+    opt.add_argument('--port', type=int, default=8000)
+    opt.add_argument('--latency', type=float, default=0.0, help='Mean seconds added to each API request')
+    opt.add_argument('--fail', type=float, default=0.0, help='Fraction of API requests answered with 503')
+    opt.add_argument('--rate', type=float, default=0, help='API requests per second before 429 is returned, 0: no limit')
+    opt.add_argument('--queue', type=float, nargs=2, default=[0, 1], help='Min. and max. seconds a job stays In Queue')
+    opt.add_argument('--run', type=float, nargs=2, default=[1, 5], help='Min. and max. seconds a job runs')
+    opt.add_argument('--stop', type=float, default=0.0, help='Fraction of jobs that end up Stopped')
+    opt.add_argument('--page', type=int, default=1000, help='Job records per page')
+    args=opt.parse_args()
+    srv=MockServer(args.host, args.port, latency=args.latency, fail_rate=args.fail, rate_limit=args.rate,
+        queue_time=tuple(args.queue), run_time=tuple(args.run), stop_rate=args.stop, page_size=args.page)
+    print(f"Mock Tamarind API at {srv.base_url}, use any API key. Ctrl-C to stop.")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=="__main__":
+    main()
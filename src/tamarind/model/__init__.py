@@ -0,0 +1,13 @@
+"""Registry of model modules, each module provides class App and a main() for tmrrun"""
+import os,importlib,functools
+
+@functools.lru_cache(maxsize=None)
+def models():
+    """Sorted names of model modules, found by listing this folder once (no module is imported)"""
+    fd=os.path.dirname(os.path.abspath(__file__))
+    return tuple(sorted(x[:-3] for x in os.listdir(fd) if x.endswith(".py") and not x.startswith("_")))
+
+def load(name):
+    """Import model module by name, None if there is no such model"""
+    if name not in models(): return None
+    return importlib.import_module(f"{__name__}.{name}")
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import tamarind.tamarind as tmr
-from tamarind.tamarind import JobManagement, Model
-import os,pandas as pd,re
+from tamarind.tamarind import JobManagement, Model, pd
+import os,re
 import argparse as arg
 
 class App(Model): # Do not rename the class
@@ -21,8 +21,9 @@ class App(Model): # Do not rename the class
         If you want to recompute a previous name, use delete/delete_all first
         """
         opt = self.get_options(options)
+        self.preflight([name], [seq], custom_template)
 
-        S_tmpl = self.upload_templates(name, custom_template)[0]
+        S_tmpl = self.upload_templates(name, custom_template, check=False)[0]
         if len(S_tmpl):
             opt["templateFiles"] = S_tmpl[0]
             opt["pdb100Templates"]=False
@@ -30,13 +31,16 @@ class App(Model): # Do not rename the class
         opt["sequence"]=seq
         super().run(name, opt, output_folder, wait)
 
-    def batch(self, batch_name, S_name, S_seq, output_folder=".", S_custom_template=None, options=None, wait=True):
+    def batch_settings(self, batch_name, S_name, S_seq, S_custom_template=None, options=None, empty_first=True):
+        """Validate entries, upload their templates and return the batch settings, see Model.stream() for chunks"""
         opt = self.get_options(options)
         n=len(S_seq)
         assert(len(S_name)==n)
         self.no_duplicate("S_name", S_name)
+        # fail fast, before anything is uploaded
+        self.preflight(S_name, S_seq, S_custom_template)
 
-        S_tmpl = self.upload_templates(S_name, S_custom_template, batch_name)
+        S_tmpl = self.upload_templates(S_name, S_custom_template, batch_name, check=False, empty_first=empty_first)
 
         # generate settings
         settings=[]
@@ -56,54 +60,65 @@ class App(Model): # Do not rename the class
             "settings": settings,
             "jobNames": jobNames
         }
+        return params
 
-        super().batch(batch_name, params, output_folder, wait)
+    def batch(self, batch_name, S_name, S_seq, output_folder=".", S_custom_template=None, options=None, wait=True, batch_size=None):
+        params = self.batch_settings(batch_name, S_name, S_seq, S_custom_template, options)
+        super().batch(batch_name, params, output_folder, wait, batch_size)
         #// If we need to compile a result.csv file
         self.results(output_folder)
 
     @staticmethod
-    def results(output_folder):
-        if not os.path.exists(output_folder):
-            return
-        jobs=os.listdir(output_folder)
-        out=[]
-        for fd in jobs:
-            #// This should be overwritten depending on the model ouput
-            fn=os.path.join(output_folder, fd, "metrics.csv")
-            if os.path.exists(fn):
-                t=pd.read_csv(fn)
-                t.sort_values('Rank', ascending=True, inplace=True)
-                t['name']=fd
-                t['Pdb Path']=t['Pdb Path'].apply(lambda x: os.path.join(output_folder, fd, x))
-                out.append(t)
-        if len(out):
-            t=pd.concat(out, ignore_index=True)
-            t.to_csv(os.path.join(output_folder, f"results.csv"), index=False)
-            return t
-        return None
+    def results(output_folder, return_frame=True):
+        #// This should be overwritten depending on the model ouput: metrics file, sort column and structure path column
+        return tmr.aggregate_results(output_folder, "metrics.csv", sort_by='Rank', ascending=True, path_col='Pdb Path', model='alphafold', return_frame=return_frame)
 
 def main():
     opt = arg.ArgumentParser(description='Run AlphaFold')
     opt.add_argument('-n','--name', type=str, default=None, help='batch name, should be unique.')
     opt.add_argument('-o','--output', type=str, default=".", help='Folder to store results.')
     opt.add_argument('--setting', type=str, default=None, help='JSON string that overwrites the default model settings')
+    opt.add_argument('--format', type=str, default="csv", choices=["csv","parquet","feather"], help='Format of the merged results file, parquet/feather require pyarrow')
+    opt.add_argument('--dataset', type=str, default=None, help='Also write parquet/feather results into this dataset folder, partitioned by model and batch')
+    opt.add_argument('--rerun', action='store_true', help='Submit all jobs, even those identical to completed earlier jobs, which are otherwise served from their results')
+    opt.add_argument('--preflight', action='store_true', help='Only validate sequences and templates locally, nothing is submitted')
     opt.add_argument('--debug', action='store_true', help='Print message from the API')
     opt.add_argument('-W','--nowait', action="store_true", help='Exit right after submission without monitoring, you will need to download results later using tmrdownload.')
-    opt.add_argument('input', type=str, default=None, help='Input .csv file, require columns: "name", "sequence", "template". Column "template" is optional.')
+    opt.add_argument('--chunk', type=int, default=None, help='Stream the input in chunks of this many rows, each submitted as a shard once read, for inputs too large to load at once')
+    opt.add_argument('input', type=str, default=None, help='Input .csv file, require columns: "name", "sequence", "template". Column "template" is optional. Or a FASTA file (.fa/.fasta/.faa, may be .gz).')
     args=opt.parse_args()
     if args.debug:
         tmr.DEBUG = True
+    tmr.RESULTS_FORMAT = args.format
+    tmr.RESULTS_DATASET = args.dataset
+    tmr.DEDUP = not args.rerun
     opt=tmr.parse_json(args.setting)
+    # no API call before submission, so --preflight works offline
     m = App()
-    jobs = m.jm.get_jobs(job_name=args.name)
-    if len(jobs)>0:
-        print(f"Error> Job name {args.name} already exists!")
+    templates = lambda t: t.template.tolist() if 'template' in t.columns else None
+    # checked before any chunk is read
+    tmr.require_columns(args.input, ['name','sequence'])
+    if args.chunk:
+        chunks = tmr.read_input(args.input, chunksize=args.chunk)
+        if args.preflight:
+            n=0
+            for t in chunks:
+                m.preflight(t.name.tolist(), t.sequence.tolist(), templates(t))
+                n+=len(t)
+            print(f"Preflight passed: {n} entries.")
+            exit()
+        m.check_name(args.name)
+        name = args.name or m.jm.generate_temp_job_name()
+        chunks = (m.batch_settings(name, t.name.tolist(), t.sequence.tolist(), templates(t), opt, empty_first=i==0) for i,t in enumerate(chunks))
+        m.stream(name, chunks, output_folder=args.output, wait=not args.nowait)
+        return
+    t = tmr.read_input(args.input)
+    S_template = templates(t)
+    if args.preflight:
+        m.preflight(t.name.tolist(), t.sequence.tolist(), S_template)
+        print(f"Preflight passed: {len(t)} entries.")
         exit()
-    t = pd.read_csv(args.input)
-    for col in ['name','sequence']:
-        if col not in t.columns:
-            print(f"ERROR> missing required column {col}.")
-    S_template = t.template.tolist() if 'template' in t.columns else None
+    m.check_name(args.name)
     #m.run(args.name, t.sequence.tolist()[0], output_folder=args.output, custom_template=S_template, options=opt, wait=not args.nowait)
     m.batch(args.name, t.name.tolist(), t.sequence.tolist(), output_folder=args.output, S_custom_template=S_template, options=opt, wait=not args.nowait)
 
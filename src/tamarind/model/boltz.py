@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import tamarind.tamarind as tmr
-from tamarind.tamarind import JobManagement, Model
-import os,pandas as pd,re
+from tamarind.tamarind import JobManagement, Model, pd
+import os,re
 import argparse as arg
 
 class App(Model): # Do not rename the class
@@ -24,21 +24,28 @@ class App(Model): # Do not rename the class
         If you want to recompute a previous name, use delete/delete_all first
         """
         opt = self.get_options(options)
+        self.preflight([name], [seq] if opt["inputFormat"]=="sequence" else None, custom_template)
 
-        S_tmpl = self.upload_templates(name, custom_template)[0]
+        S_tmpl = self.upload_templates(name, custom_template, check=False)[0]
         if len(S_tmpl):
             opt["templateFiles"] = S_tmpl[0]
 
         opt["sequence"]=seq
         super().run(name, opt, output_folder, wait)
 
-    def batch(self, batch_name, S_name, S_seq, S_custom_template=None, output_folder=".", options=None, wait=True):
+    def batch_settings(self, batch_name, S_name, S_seq, S_custom_template=None, options=None, empty_first=True):
+        """Validate entries, upload the templates and return the batch settings, see Model.stream() for chunks"""
         opt = self.get_options(options)
+        if isinstance(S_custom_template, list):
+            # shared by all entries, whatever the number of entries in this batch or chunk
+            S_custom_template=";".join(x for x in S_custom_template if pd.notnull(x))
         n=len(S_seq)
         assert(len(S_name)==n)
         self.no_duplicate("S_name", S_name)
+        # fail fast, before anything is uploaded
+        self.preflight(S_name, S_seq if opt["inputFormat"]=="sequence" else None, S_custom_template)
 
-        S_tmpl = self.upload_templates(S_name, S_custom_template, batch_name)
+        S_tmpl = self.upload_templates(S_name, S_custom_template, batch_name, check=False, empty_first=empty_first)
         # merge all templates, as they are shared within a batch
         S_tmpl = sorted(list({x for X in S_tmpl for x in X if x!=''}))
 
@@ -71,62 +78,80 @@ class App(Model): # Do not rename the class
             "settings": settings,
             "jobNames": jobNames
         }
+        return params
 
-        super().batch(batch_name, params, output_folder, wait)
+    def batch(self, batch_name, S_name, S_seq, S_custom_template=None, output_folder=".", options=None, wait=True, batch_size=None):
+        params = self.batch_settings(batch_name, S_name, S_seq, S_custom_template, options)
+        super().batch(batch_name, params, output_folder, wait, batch_size)
         #// If we need to compile a result.csv file
         self.results(output_folder)
 
     @staticmethod
-    def results(output_folder):
-        if not os.path.exists(output_folder):
-            return
-        jobs=os.listdir(output_folder)
-        out=[]
-        for fd in jobs:
-            #// This should be overwritten depending on the model ouput
-            fn=os.path.join(output_folder, fd, "metrics.csv")
-            if os.path.exists(fn):
-                t=pd.read_csv(fn)
-                t.sort_values('iptm', ascending=False, inplace=True)
-                t['name']=fd
-                t['pdb_filepath']=t['pdb_filepath'].apply(lambda x: os.path.join(output_folder, fd, x))
-                # there is a bug in pdb_filepath, so we fix it ourselves for now, will delete when it's fixed
-                t['pdb_filepath']=t['pdb_filepath'].apply(lambda x: x.replace('result_result_', 'result_'))
-                out.append(t)
-        if len(out):
-            t=pd.concat(out, ignore_index=True)
-            t.to_csv(os.path.join(output_folder, f"results.csv"), index=False)
-            return t
-        return None
+    def results(output_folder, return_frame=True):
+        #// This should be overwritten depending on the model ouput: metrics file, sort column and structure path column
+        # there is a bug in pdb_filepath, so we fix it ourselves for now, will delete when it's fixed
+        fix=lambda S: S.str.replace('result_result_', 'result_', regex=False)
+        return tmr.aggregate_results(output_folder, "metrics.csv", sort_by='iptm', ascending=False, path_col='pdb_filepath', fix=fix, model='boltz', return_frame=return_frame)
 
 def main():
     #// Update the job_type below
     opt = arg.ArgumentParser(description='Run Boltz')
     opt.add_argument('-n','--name', type=str, default=None, help='batch name, should be unique.')
     opt.add_argument('-o','--output', type=str, default=".", help='Folder to store results.')
-    opt.add_argument('input', type=str, default=None, help='Input .csv file, require columns: "name", "sequence".')
+    opt.add_argument('input', type=str, default=None, help='Input .csv file, require columns: "name", "sequence". Or a FASTA file (.fa/.fasta/.faa, may be .gz).')
     opt.add_argument('--setting', type=str, default=None, help='JSON string that overwrites the default model settings')
+    opt.add_argument('--format', type=str, default="csv", choices=["csv","parquet","feather"], help='Format of the merged results file, parquet/feather require pyarrow')
+    opt.add_argument('--dataset', type=str, default=None, help='Also write parquet/feather results into this dataset folder, partitioned by model and batch')
+    opt.add_argument('--rerun', action='store_true', help='Submit all jobs, even those identical to completed earlier jobs, which are otherwise served from their results')
+    opt.add_argument('--preflight', action='store_true', help='Only validate sequences and templates locally, nothing is submitted')
     opt.add_argument('--debug', action='store_true', help='Print message from the API')
     opt.add_argument('-W','--nowait', action="store_true", help='Exit right after submission without monitoring, you will need to download results later using tmrdownload.')
+    opt.add_argument('--chunk', type=int, default=None, help='Stream the input in chunks of this many rows, each submitted as a shard once read, for inputs too large to load at once')
     args=opt.parse_args()
     if args.debug:
         tmr.DEBUG = True
+    tmr.RESULTS_FORMAT = args.format
+    tmr.RESULTS_DATASET = args.dataset
+    tmr.DEDUP = not args.rerun
     opt=tmr.parse_json(args.setting)
+    # no API call before submission, so --preflight works offline
     m = App()
-    jobs = m.jm.get_jobs(job_name=args.name)
-    if len(jobs)>0:
-        print(f"Error> Job name {args.name} already exists!")
-        exit()
-    t = pd.read_csv(args.input)
-    for col in ['name','sequence']:
-        if col not in t.columns:
-            print(f"ERROR> missing required column {col}.")
     # boltz model share the same templates per batch
-    S_template = t.template.tolist() if 'template' in t.columns else None
-    if S_template is not None:
-        S=[x for x in S_template if pd.notnull(x)]
-        S_template=list(set(x.strip() for x in re.split(r';\s*', ";".join(S))))
-        print(f"Custom templates provided: {len(S_template)}.")
+    def shared_templates(T):
+        c_tmpl=set()
+        for t in T:
+            if 'template' in t.columns:
+                c_tmpl.update(x.strip() for s in t.template if pd.notnull(s) for x in re.split(r';\s*', s))
+        if len(c_tmpl)==0: return None
+        print(f"Custom templates provided: {len(c_tmpl)}.")
+        return sorted(c_tmpl)
+    seq = lambda t: t.sequence.tolist() if m.get_options(opt)["inputFormat"]=="sequence" else None
+    # checked before any chunk is read
+    tmr.require_columns(args.input, ['name','sequence'])
+    if args.chunk:
+        # templates are needed by every chunk, collect them first by reading only the template column
+        has_tmpl = 'template' in tmr.input_columns(args.input)
+        S_template = shared_templates(tmr.read_input(args.input, chunksize=args.chunk, usecols=['template'])) if has_tmpl else None
+        chunks = tmr.read_input(args.input, chunksize=args.chunk)
+        if args.preflight:
+            n=0
+            for i,t in enumerate(chunks):
+                m.preflight(t.name.tolist(), seq(t), S_template if i==0 else None)
+                n+=len(t)
+            print(f"Preflight passed: {n} entries.")
+            exit()
+        m.check_name(args.name)
+        name = args.name or m.jm.generate_temp_job_name()
+        chunks = (m.batch_settings(name, t.name.tolist(), t.sequence.tolist(), S_template, opt, empty_first=i==0) for i,t in enumerate(chunks))
+        m.stream(name, chunks, output_folder=args.output, wait=not args.nowait)
+        return
+    t = tmr.read_input(args.input)
+    S_template = shared_templates([t])
+    if args.preflight:
+        m.preflight(t.name.tolist(), seq(t), S_template)
+        print(f"Preflight passed: {len(t)} entries.")
+        exit()
+    m.check_name(args.name)
     m.batch(args.name, t.name.tolist(), t.sequence.tolist(), S_custom_template=S_template, output_folder=args.output, options=opt,)
     print(f"Job completed, outputs in {args.output}.\nPlease delete the batch with: deljob.py {args.name}")
 
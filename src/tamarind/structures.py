@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""SQLite index of predicted structures in download folders, so the best model of a job, or the pLDDT
+of a chain, is found without opening PDB/CIF files again. Each file is parsed once, memory-mapped,
+only CA (protein) and C1' (nucleic acid) atom records of the first model are read.
+The B-factor column is taken as pLDDT, as AlphaFold, Boltz and IntFold write it there.
+
+Rows are keyed by absolute file path, update() only parses files that are new or modified
+(size/mtime) and drops files that are gone. JobManagement does this after downloads, see
+tamarind.tamarind.index_structures().
+
+    from tamarind.structures import StructureIndex
+    idx=StructureIndex("structures.db")
+    idx.update("output_folder")
+    print(idx.models(best=True, min_plddt=80))
+"""
+import os,re,mmap,gzip,time,sqlite3,threading
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS models (path TEXT PRIMARY KEY, folder TEXT, batch TEXT, job TEXT, rank INTEGER,
+    format TEXT, size INTEGER, mtime INTEGER, chains TEXT, n_chain INTEGER, length INTEGER, plddt REAL, indexed REAL);
+CREATE INDEX IF NOT EXISTS models_folder ON models (folder, job);
+CREATE INDEX IF NOT EXISTS models_job ON models (job, rank);
+CREATE INDEX IF NOT EXISTS models_batch ON models (batch, rank);
+CREATE INDEX IF NOT EXISTS models_rank ON models (rank, plddt);
+CREATE INDEX IF NOT EXISTS models_plddt ON models (plddt);
+CREATE TABLE IF NOT EXISTS chains (path TEXT, chain TEXT, length INTEGER, plddt REAL, PRIMARY KEY (path, chain)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chains_chain ON chains (chain, plddt);
+"""
+# structure file extensions, optionally .gz
+EXT=(".pdb", ".cif", ".mmcif")
+# rank in a file name, e.g., ColabFold's _rank_001_; otherwise models of a job are ranked by mean pLDDT
+RANK=re.compile(r"rank[_-]?0*(\d+)", re.I)
+# PDB ATOM record of a CA or C1' atom: chain, residue number + insertion code, B-factor
+PDB_ATOM=re.compile(rb"^ATOM  .{6}(?: CA | C1').(?:.{4})(.)(.{5}).{33}(.{6})", re.M)
+# max. number of ? in one SQL statement
+_CHUNK=500
+
+def parse_pdb(buf):
+    """chain -> [residues, sum of B-factors] from PDB content (bytes or mmap), first model only"""
+    end=buf.find(b"\nENDMDL")
+    out={}
+    last=None
+    for m in PDB_ATOM.finditer(buf, 0, len(buf) if end<0 else end):
+        chain,res,b=m.groups()
+        # alternate locations repeat a residue
+        if (chain,res)==last: continue
+        last=(chain,res)
+        x=out.get(chain)
+        if x is None: x=out[chain]=[0, 0.0]
+        x[0]+=1
+        x[1]+=float(b)
+    return {k.decode().strip() or "_":v for k,v in out.items()}
+
+def parse_cif(buf):
+    """chain -> [residues, sum of B-factors] from mmCIF content (bytes or mmap), first model only.
+    A regex is built from the _atom_site header, so only CA/C1' rows are split into fields.
+    """
+    i=buf.find(b"\n_atom_site.")
+    if i<0: return {}
+    pos=i+1
+    S_col=[]
+    while buf[pos:pos+11]==b"_atom_site.":
+        j=buf.find(b"\n", pos)
+        j=len(buf) if j<0 else j
+        S_col.append(buf[pos+11:j].strip().decode())
+        pos=j+1
+    col=lambda *X: next((S_col.index(x) for x in X if x in S_col), None)
+    i_atom=col('label_atom_id', 'auth_atom_id')
+    i_chain=col('auth_asym_id', 'label_asym_id')
+    i_res=col('auth_seq_id', 'label_seq_id')
+    i_b=col('B_iso_or_equiv')
+    i_model=col('pdbx_PDB_model_num')
+    if None in (i_atom, i_chain, i_res, i_b): return {}
+    S_keep=sorted(x for x in (i_chain, i_res, i_b, i_model) if x is not None)
+    parts=[]
+    for k in range(len(S_col)):
+        if k==0 and S_col[0]=='group_PDB':
+            parts.append("(?:ATOM|HETATM)")
+        elif k==i_atom:
+            parts.append(r"""(?:CA|C1'|"C1'")""")
+        elif k in S_keep:
+            parts.append(r"(\S+)")
+        else:
+            parts.append(r"""(?:"[^"]*"|\S+)""")
+    pat=re.compile("^"+r"[ \t]+".join(parts)+r"[ \t]*\r?$", re.M)
+    # the atom_site loop ends at the next "#" line, or the end of file
+    end=buf.find(b"\n#", pos)
+    s=buf[pos:len(buf) if end<0 else end].decode('utf-8', 'ignore')
+    out={}
+    last=None
+    model=None
+    for m in pat.finditer(s):
+        X=dict(zip(S_keep, m.groups()))
+        if i_model is not None:
+            if model is None: model=X[i_model]
+            elif X[i_model]!=model: break
+        chain,res=X[i_chain],X[i_res]
+        if (chain,res)==last: continue
+        last=(chain,res)
+        x=out.get(chain)
+        if x is None: x=out[chain]=[0, 0.0]
+        x[0]+=1
+        x[1]+=float(X[i_b])
+    return out
+
+def parse_structure(fn):
+    """Parse a .pdb/.cif file (may be .gz), return (format, chain -> [residues, sum of B-factors])"""
+    name=fn[:-3] if fn.endswith(".gz") else fn
+    fmt="pdb" if name.endswith(".pdb") else "cif"
+    f=parse_pdb if fmt=="pdb" else parse_cif
+    if fn.endswith(".gz"):
+        with gzip.open(fn, 'rb') as fh:
+            return fmt, f(fh.read())
+    if os.path.getsize(fn)==0: return fmt, {}
+    with open(fn, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return fmt, f(mm)
+
+def structure_files(folder):
+    """Structure files under folder, hidden folders are skipped"""
+    out=[]
+    for root,S_dir,S_file in os.walk(folder):
+        S_dir[:]=[x for x in S_dir if not x.startswith(".")]
+        for x in S_file:
+            if (x[:-3] if x.endswith(".gz") else x).lower().endswith(EXT):
+                out.append(os.path.join(root, x))
+    return out
+
+class StructureIndex:
+    """SQLite index of structure files, shared by threads (and processes) using the same file.
+    If path is None or the database cannot be opened, updates do nothing and queries return nothing.
+    """
+
+    def __init__(self, path):
+        self.path=path
+        self.lock=threading.Lock()
+        self.db=None
+        if not path: return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db=sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: structure index {path} is disabled: {e}")
+            self.db=None
+
+    def _read(self, sql, args=()):
+        if self.db is None: return []
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def update(self, folder, jobs=None, n_jobs=8):
+        """Index structures of jobs downloaded into folder, only new or modified files are parsed.
+        jobs: dict job name -> job folder relative to folder, e.g., from the download manifest,
+            defaults to every sub-folder, named after the job
+        n_jobs: number of threads parsing files
+
+        return number of files parsed
+        """
+        if self.db is None: return 0
+        folder=os.path.abspath(folder)
+        if jobs is None:
+            with os.scandir(folder) as it:
+                jobs={x.name:x.name for x in it if x.is_dir() and not x.name.startswith(".")}
+        # path -> (size, mtime, job)
+        c_old={x[0]:x[1:] for x in self._read("SELECT path,size,mtime,job FROM models WHERE folder=?", (folder,))}
+        c_job={}
+        todo=[]
+        for job,sub in jobs.items():
+            for fn in structure_files(os.path.join(folder, sub)):
+                try:
+                    st=os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                c_job[fn]=job
+                if c_old.get(fn, ())[:2]!=(st.st_size, st.st_mtime_ns):
+                    todo.append((fn, st.st_size, st.st_mtime_ns))
+        S_gone=[x for x in c_old if x not in c_job]
+        def parse(x):
+            fn,size,mtime=x
+            try:
+                fmt,c_chain=parse_structure(fn)
+            except (OSError, ValueError, UnicodeDecodeError) as e:
+                print(f"Warning: cannot parse {fn}: {e}")
+                fmt,c_chain=None,{}
+            return fn,size,mtime,fmt,c_chain
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            out=list(pool.map(parse, todo))
+        batch=os.path.basename(folder)
+        now=time.time()
+        rows=[]
+        chains=[]
+        for fn,size,mtime,fmt,c_chain in out:
+            n=sum(v[0] for v in c_chain.values())
+            rows.append((fn, folder, batch, c_job[fn], None, fmt, size, mtime, ",".join(c_chain), len(c_chain), n,
+                sum(v[1] for v in c_chain.values())/n if n else None, now))
+            chains+=[(fn, k, v[0], v[1]/v[0] if v[0] else None) for k,v in c_chain.items()]
+        S_path=[x[0] for x in rows]+S_gone
+        S_touched={c_job[x[0]] for x in rows}|{c_old[x][2] for x in S_gone}
+        with self.lock, self.db:
+            for i in range(0, len(S_path), _CHUNK):
+                X=S_path[i:i+_CHUNK]
+                self.db.execute(f"DELETE FROM models WHERE path IN ({','.join('?'*len(X))})", X)
+                self.db.execute(f"DELETE FROM chains WHERE path IN ({','.join('?'*len(X))})", X)
+            self.db.executemany("INSERT INTO models VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+            self.db.executemany("INSERT INTO chains VALUES (?,?,?,?)", chains)
+            # rank models of the jobs that changed
+            S_rank=[]
+            for job in S_touched:
+                S=self.db.execute("SELECT path,plddt FROM models WHERE folder=? AND job=?", (folder, job)).fetchall()
+                S_named=[RANK.search(os.path.basename(p)) for p,_ in S]
+                if all(S_named):
+                    S_rank+=[(int(m.group(1)), p) for (p,_),m in zip(S, S_named)]
+                else:
+                    S.sort(key=lambda x: (x[1] is None, -(x[1] or 0), x[0]))
+                    S_rank+=[(i+1, p) for i,(p,_) in enumerate(S)]
+            self.db.executemany("UPDATE models SET rank=? WHERE path=?", S_rank)
+        return len(rows)
+
+    def remove(self, folder):
+        """Drop all structures indexed under folder"""
+        if self.db is None: return
+        folder=os.path.abspath(folder)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM chains WHERE path IN (SELECT path FROM models WHERE folder=?)", (folder,))
+            self.db.execute("DELETE FROM models WHERE folder=?", (folder,))
+
+    def models(self, folder=None, batch=None, job=None, best=False, min_plddt=None):
+        """Dataframe of indexed models, filtered by output folder, batch (folder name), job name,
+        best: only the top ranked model of each job, min_plddt: mean pLDDT at least this
+        """
+        import pandas as pd
+        S_where,args=[],[]
+        for col,v in (('folder', None if folder is None else os.path.abspath(folder)), ('batch', batch), ('job', job)):
+            if v is not None:
+                S_where.append(f"{col}=?")
+                args.append(v)
+        if best: S_where.append("rank=1")
+        if min_plddt is not None:
+            S_where.append("plddt>=?")
+            args.append(min_plddt)
+        sql="SELECT job,rank,plddt,n_chain,length,chains,format,path,batch,folder FROM models"
+        if len(S_where): sql+=" WHERE "+" AND ".join(S_where)
+        return pd.DataFrame(self._read(sql+" ORDER BY folder,job,rank", args),
+            columns=['job','rank','plddt','n_chain','length','chains','format','path','batch','folder'])
+
+    def chains(self, job=None, chain=None, batch=None, best=False, min_plddt=None):
+        """Dataframe of per-chain length and mean pLDDT, filtered as in models(), min_plddt applies to the chain"""
+        import pandas as pd
+        S_where,args=[],[]
+        for col,v in (('m.job', job), ('c.chain', chain), ('m.batch', batch)):
+            if v is not None:
+                S_where.append(f"{col}=?")
+                args.append(v)
+        if best: S_where.append("m.rank=1")
+        if min_plddt is not None:
+            S_where.append("c.plddt>=?")
+            args.append(min_plddt)
+        sql="SELECT m.job,m.rank,c.chain,c.length,c.plddt,m.path,m.batch FROM chains c JOIN models m ON c.path=m.path"
+        if len(S_where): sql+=" WHERE "+" AND ".join(S_where)
+        return pd.DataFrame(self._read(sql+" ORDER BY m.folder,m.job,m.rank,c.chain", args),
+            columns=['job','rank','chain','length','plddt','path','batch'])
+
+    def count(self):
+        """Number of indexed models"""
+        x=self._read("SELECT COUNT(*) FROM models")
+        return x[0][0] if len(x) else 0
@@ -1,22 +1,353 @@
 #!/usr/bin/env python
-import requests
-import pandas as pd
-import os,random,string,time,json,tqdm,zipfile,re
+import os,random,string,time,json,zipfile,re,threading,queue,hashlib,shutil,tempfile,weakref,email.utils,importlib,functools,gzip
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tamarind.ledger import Ledger, settings_hash
+from tamarind.metrics import get_metrics
+from tamarind.structures import StructureIndex
+try:
+    import fcntl
+except ImportError: # not on POSIX, the rate limit is then only shared by threads
+    fcntl=None
 
+class LazyModule:
+    """Stand-in for a module, which is imported when first used"""
+
+    def __init__(self, name):
+        self._name=name
+        self._module=None
+
+    def __getattr__(self, key):
+        if self._module is None:
+            self._module=importlib.import_module(self._name)
+        return getattr(self._module, key)
+
+# these take most of the import time, short commands, e.g., tmrmonitor -l, may not need pandas at all
+pd=LazyModule("pandas")
+requests=LazyModule("requests")
+tqdm=LazyModule("tqdm")
+
+# API server, e.g., http://127.0.0.1:8000/api/ for tamarind.mockserver
+BASE_URL=os.environ.get("TAMARIND_BASE_URL", "https://app.tamarind.bio/api/")
 proxies = {k:os.environ.get(k+"_proxy") for k in ("http","https") if os.environ.get(k+"_proxy", "")!=""}
-# interval (seconds) when pulling job status
+# sinks recording every API call, e.g., "summary,jsonl:calls.jsonl,prom:tamarind.prom", see tamarind.metrics
+METRICS=os.environ.get("TAMARIND_METRICS", "")
+# interval (seconds) when pulling job status, PollScheduler adapts it within [MIN_INTERVAL, MAX_INTERVAL]
 MONITOR_INTERVAL=10
+MIN_INTERVAL=2
+MAX_INTERVAL=300
+# max. status polls per minute, shared by all monitors within the process
+POLL_BUDGET=60
+# job status that will not change any more
+FINAL_STATUS=('Complete','Stopped')
+# JobWatcher lists all jobs again every FULL_SYNC polls, to pick up newly submitted jobs
+FULL_SYNC=30
 DEBUG=False
+# HTTP session: max. pooled connections per host, retries for 429/5xx, backoff factor (seconds)
+POOL_SIZE=10
+RETRIES=5
+BACKOFF=0.5
+# HTTP status codes that are retried
+RETRY_STATUS=(429, 500, 502, 503, 504)
+# (connect, read) timeouts in seconds
+TIMEOUT=(10, 300)
+# max. API requests per second, shared by all processes on the host using the same API key, 0 disables it
+RATE_LIMIT=float(os.environ.get("TAMARIND_RATE_LIMIT", 10))
+# max. requests sent at once after an idle period, defaults to RATE_LIMIT
+RATE_BURST=float(os.environ.get("TAMARIND_RATE_BURST", 0))
+# state file of the host-wide rate limiter, defaults to a file per API key in the temp folder
+RATE_FILE=os.environ.get("TAMARIND_RATE_FILE")
+# seconds a job listing is reused by get_jobs(), 0 disables the cache
+CACHE_TTL=30
+# if set, job listings are also cached in this folder, so they are shared by processes
+CACHE_DIR=os.environ.get("TAMARIND_CACHE_DIR")
+# SQLite file recording our jobs, see tamarind.ledger, "" disables it
+LEDGER=os.environ.get("TAMARIND_LEDGER", os.path.join(os.path.expanduser("~"), ".tamarind", "ledger.db"))
+# sync_ledger() lists all jobs if the last full listing is older than LEDGER_SYNC seconds,
+# or more than LEDGER_DELTA calls are needed to refresh unfinished jobs
+LEDGER_SYNC=3600
+LEDGER_DELTA=50
+# Model.batch serves jobs whose model and settings match a completed earlier job from its results, see dedup_batch()
+DEDUP=True
+# number of parallel result downloads
+DOWNLOAD_WORKERS=4
+# max. jobs waiting between the stages of monitor_batch() (poll -> download -> callback)
+PIPELINE_QUEUE=1000
+# max. number of jobs per submit-batch request, larger batches are submitted as shards in parallel
+BATCH_SIZE=1000
+SUBMIT_WORKERS=4
+# input files with these extensions (optionally .gz) are read as FASTA by read_input()
+FASTA_EXT=(".fa", ".fasta", ".faa", ".fas")
+# number of threads reading metrics files in aggregate_results()
+READ_WORKERS=8
+# file in an output folder recording which job metrics files are already merged into results.csv
+RESULTS_STATE=".results_state.json"
+# format of the merged results file: csv, parquet or feather (the latter two require pyarrow)
+RESULTS_FORMAT="csv"
+# if set, parquet/feather results are also written into this dataset folder, partitioned by model and batch
+RESULTS_DATASET=None
+# number of parallel file uploads
+UPLOAD_WORKERS=8
+# number of parallel delete requests, and max. delete requests per second
+DELETE_WORKERS=8
+DELETE_RATE=20
+# bytes read from a file of unknown extension to guess its format
+SNIFF_BYTES=4096
+# residue letters accepted in sequences by Model.preflight(), chains are separated by ":"
+SEQ_ALPHABET="ACDEFGHIKLMNPQRSTVWYXBZUO"
+# chunk size (bytes) when streaming result archives to disk
+CHUNK_SIZE=1<<20
+# file name of the download manifest kept in each output folder
+MANIFEST_FILE=".tamarind_manifest.jsonl"
+# SQLite index of downloaded structures (chains, lengths, pLDDT, rank), see tamarind.structures, "" disables it
+STRUCTURE_INDEX=os.environ.get("TAMARIND_STRUCTURE_INDEX", os.path.join(os.path.expanduser("~"), ".tamarind", "structures.db"))
+
+@functools.lru_cache(maxsize=None)
+def jitter_retry():
+    """Return class JitterRetry, it is defined on first use, so urllib3 is only imported when needed"""
+    from urllib3.util.retry import Retry
+    from urllib3.exceptions import MaxRetryError, ResponseError
+
+    class JitterRetry(Retry):
+        """Exponential backoff with random jitter, so parallel clients do not retry in lockstep.
+        A 429 with Retry-After also pauses the host-wide rate limiters, see RateLimiter. If limiter is set,
+        each retry takes a token from it, as the first attempt did.
+        Submissions (NO_REPLAY) are only retried if they were not sent (connect errors) or were
+        rejected (429/503), a read error or other 5xx may come after the server accepted the job.
+        """
+        NO_REPLAY=("submit-job", "submit-batch")
+        limiter=None
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            if response is not None and response.status==429:
+                t=self.get_retry_after(response)
+                if t: RateLimiter.pause_all(t)
+            if url and url.split("?")[0].rstrip("/").endswith(self.NO_REPLAY):
+                if error is not None and not self._is_connection_error(error):
+                    raise error
+                if error is None and response is not None and response.status not in (429, 503):
+                    # with raise_on_status=False, the caller gets this response
+                    raise MaxRetryError(_pool, url, ResponseError(f"{response.status} response to a submission"))
+            return super().increment(method, url, response, error, _pool, _stacktrace)
+
+        def get_backoff_time(self):
+            t=super().get_backoff_time()
+            return random.uniform(t/2, t) if t>0 else t
+
+        def sleep(self, response=None):
+            super().sleep(response)
+            if self.limiter is not None: self.limiter.acquire()
+
+        def new(self, **kw):
+            # urllib3 makes a new object for every retry
+            out=super().new(**kw)
+            out.limiter=self.limiter
+            return out
+
+    return JitterRetry
+
+def new_session(pool_size=None, retries=None, backoff=None, limiter=None, base_url=None):
+    """Create a requests.Session with pooled keep-alive connections, it retries on
+    connection errors, 429 and 5xx with exponential backoff. Retry-After is honored.
+    limiter, base_url: retries of requests under base_url take tokens from the RateLimiter,
+        other requests (e.g., downloads of results from storage) do not
+    """
+    from requests.adapters import HTTPAdapter
+    retries=RETRIES if retries is None else retries
+    pool_size=pool_size or POOL_SIZE
+    def adapter(limiter=None):
+        retry=jitter_retry()(total=retries, connect=retries, read=retries, status=retries,
+            backoff_factor=BACKOFF if backoff is None else backoff,
+            status_forcelist=RETRY_STATUS,
+            # POST is retried too, results/uploads are keyed by names, JitterRetry never replays an accepted submission
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        retry.limiter=limiter
+        return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session=requests.Session()
+    session.mount("https://", adapter())
+    session.mount("http://", adapter())
+    if limiter is not None and base_url:
+        # the longest matching prefix wins
+        session.mount(base_url, adapter(limiter))
+    return session
+
+class Manifest:
+    """Record of jobs downloaded into an output folder: job name -> folder, etag, size, completed time.
+    Stored as JSON lines, each update is one appended line, the last line of a job wins.
+    Use Manifest.open(), so threads downloading into the same folder share one instance.
+    """
+    _cache={}
+    _lock=threading.Lock()
+
+    @classmethod
+    def open(cls, output_folder):
+        key=os.path.abspath(output_folder)
+        with cls._lock:
+            if key not in cls._cache:
+                cls._cache[key]=cls(output_folder)
+            return cls._cache[key]
+
+    def __init__(self, output_folder):
+        self.output_folder=output_folder
+        self.path=os.path.join(output_folder, MANIFEST_FILE)
+        self.data={}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for s in f:
+                    try:
+                        r=json.loads(s)
+                    except json.JSONDecodeError: # line truncated by an interrupted run
+                        continue
+                    self.data.setdefault(r.pop('job'), {}).update(r)
+
+    def get(self, job_name):
+        return self.data.get(job_name, {})
+
+    def is_done(self, job_name):
+        """Results were completely downloaded and the job folder is still there"""
+        r=self.get(job_name)
+        return r.get('completed') is not None and os.path.isdir(os.path.join(self.output_folder, r['folder']))
+
+    def jobs(self):
+        """job name -> folder, for jobs completely downloaded"""
+        return {k:r['folder'] for k,r in self.data.items() if r.get('completed') is not None and 'folder' in r}
+
+    def update(self, job_name, **kw):
+        with Manifest._lock:
+            self.data.setdefault(job_name, {}).update(kw)
+            os.makedirs(self.output_folder, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'job':job_name, **kw})+"\n")
+
+class JobCache:
+    """Job records returned by the jobs endpoint, keyed by the query parameters, expire after ttl seconds.
+    A cached listing of all jobs also answers lookups by job name.
+    If folder is set, entries are also stored there as JSON files, shared by processes.
+    """
+
+    def __init__(self, ttl=None, folder=None, account=""):
+        self.ttl=CACHE_TTL if ttl is None else ttl
+        self.folder=folder
+        # distinguishes accounts sharing one cache folder
+        self.account=account
+        # params key -> (time, records)
+        self.data={}
+        self.lock=threading.Lock()
+
+    def _key(self, params):
+        return json.dumps(params, sort_keys=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"jobs-{self.account}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.json")
+
+    def _load(self, params):
+        key=self._key(params)
+        with self.lock:
+            x=self.data.get(key)
+        if x is None and self.folder is not None:
+            try:
+                with open(self._path(key)) as f:
+                    x=tuple(json.load(f))
+            except (OSError, ValueError):
+                pass
+        if x is not None and time.time()-x[0]<self.ttl:
+            return x[1]
+        return None
+
+    def get(self, params):
+        """Return cached job records for params, None if not cached"""
+        if self.ttl<=0: return None
+        out=self._load(params)
+        if out is not None or 'jobName' not in params:
+            return out
+        # look up the name in a cached listing of all jobs
+        name=params['jobName']
+        base={k:v for k,v in params.items() if k not in ('jobName', 'includeSubjobs')}
+        for expand in (True, False):
+            listing=self._load({**base, 'includeSubjobs': "true"} if expand else base)
+            if listing is None: continue
+            # as returned by a lookup by name, a batch entry carries no Batch field
+            out=[{k:v for k,v in r.items() if not (k=='Batch' and r.get('Type')=='batch')} for r in listing if r.get('JobName')==name]
+            # only the listing with sub jobs is complete, a miss in the other one is not conclusive
+            if len(out) or expand: return out
+        return None
+
+    def put(self, params, out):
+        if self.ttl<=0: return
+        key=self._key(params)
+        x=(time.time(), out)
+        with self.lock:
+            self.data[key]=x
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp=self._path(key)+f".{os.getpid()}"
+            with open(tmp, 'w') as f:
+                json.dump(x, f)
+            os.replace(tmp, self._path(key))
+
+    def invalidate(self):
+        """Called when jobs are submitted or deleted"""
+        with self.lock:
+            self.data.clear()
+        if self.folder is not None and os.path.isdir(self.folder):
+            for fn in os.listdir(self.folder):
+                if fn.startswith(f"jobs-{self.account}-"):
+                    try:
+                        os.remove(os.path.join(self.folder, fn))
+                    except OSError:
+                        pass
 
 class JobManagement:
 
-    def __init__(self, api_key=None, base_url="https://app.tamarind.bio/api/"):
+    def __init__(self, api_key=None, base_url=None, pool_size=None, retries=None, timeout=None, cache_ttl=None, ledger=None):
+        """base_url: defaults to BASE_URL
+        pool_size, retries, timeout: default to module-level POOL_SIZE, RETRIES, TIMEOUT
+        cache_ttl: seconds job listings are reused, defaults to CACHE_TTL
+        ledger: SQLite file recording our jobs, defaults to LEDGER
+        """
         self.api_key = api_key or os.environ.get("TAMARIND_API_KEY", None)
         if self.api_key is None:
             print("ERROR> API key not found, please set it with environment variable TAMARIND_API_KEY")
             exit()
-        self.base_url = base_url
+        self.base_url = base_url = base_url or BASE_URL
         self.headers = {'x-api-key': self.api_key}
+        self.timeout = timeout or TIMEOUT
+        account=account_key(self.api_key, base_url)
+        # all API requests (retries included) by processes on this host with the same key share one budget
+        self.limiter = host_limiter(account)
+        # one session shared by all calls, so connections are reused
+        self.session = new_session(pool_size, retries, limiter=self.limiter, base_url=base_url)
+        # (folder, content hash) -> remote path of files uploaded by this object
+        self.c_uploaded = {}
+        # batch name -> list of its shard names, see submit_batches()
+        self.c_shards = {}
+        self.cache = JobCache(cache_ttl, CACHE_DIR, account=account)
+        self.ledger = Ledger(LEDGER if ledger is None else ledger, account=account, final_status=FINAL_STATUS)
+        self.metrics = get_metrics(METRICS)
+
+    def _request(self, method, endpoint, **kw):
+        """Send an API request through the shared session, once the host-wide rate limiter allows it"""
+        kw.setdefault('headers', self.headers)
+        kw.setdefault('timeout', self.timeout)
+        t0=time.perf_counter()
+        self.limiter.acquire()
+        t1=time.perf_counter()
+        try:
+            response=self.session.request(method, self.base_url + endpoint, **kw)
+        except requests.RequestException as e:
+            if self.metrics: self.metrics.record(endpoint.split("/")[0], 0, time.perf_counter()-t1, wait=t1-t0, error=type(e).__name__)
+            raise
+        if self.metrics:
+            retries=getattr(response.raw, 'retries', None)
+            self.metrics.record(endpoint.split("/")[0], response.status_code, time.perf_counter()-t1, wait=t1-t0,
+                bytes_in=len(response.content), bytes_out=int(response.request.headers.get('Content-Length', 0)),
+                retries=len(retries.history) if retries is not None else 0)
+        if response.status_code==429:
+            # retries are used up, make other processes back off as well
+            self.limiter.pause(retry_after(response.headers.get('Retry-After')) or MONITOR_INTERVAL)
+        return response
 
     def generate_temp_job_name(self, length=6):
         """Generate a temporary job name of six characters"""
@@ -35,10 +366,13 @@ class JobManagement:
             "type": job_type,
             "settings": settings
         }
-        response = requests.post(self.base_url + endpoint, headers=self.headers, json=params)
+        response = self._request("POST", endpoint, json=params)
+        self.cache.invalidate()
         if DEBUG: print(response.text)
         if response.status_code!=200:
             raise Exception(f"Job {job_name} cannot be created! "+response.text)
+        # submit-job rejects names in use, so the name is ours
+        self.ledger.submitted([job_name], job_type, [self.settings_key(job_type, settings)], replace=True, sent=[settings_hash(settings)])
         return response.text
 
     def submit_batch(self, batch_name, job_type, settings):
@@ -48,10 +382,167 @@ class JobManagement:
         endpoint = "submit-batch"
         settings["batchName"] = batch_name
         settings["type"] = job_type
-        response = requests.post(self.base_url + endpoint, headers=self.headers, json=settings)
+        response = self._request("POST", endpoint, json=settings)
+        self.cache.invalidate()
         if DEBUG: print(response.text)
+        if response.status_code!=200:
+            raise Exception(f"Batch {batch_name} cannot be created! "+response.text)
+        self.ledger.submitted([batch_name], job_type, is_batch=True, replace=True)
+        S_name=settings["jobNames"]
+        S_key=[self.settings_key(job_type, x) for x in settings["settings"]]
+        S_sent=[settings_hash(x) for x in settings["settings"]]
+        kept=self.ledger.submitted(S_name, job_type, S_key, batch=batch_name, sent=S_sent)
+        if len(kept) and self.ledger.db is not None:
+            # the names belong to other jobs, find the names the server gave to ours
+            c_created=created_names(self.get_shard_jobs(batch_name), batch_name, [S_name[i] for i in kept], [settings["settings"][i] for i in kept])
+            S_found=[i for i in kept if S_name[i] in c_created]
+            self.ledger.submitted([c_created[S_name[i]] for i in S_found], job_type, [S_key[i] for i in S_found], batch=batch_name, replace=True,
+                sent=[S_sent[i] for i in S_found])
         return response.text
 
+    def submit_batches(self, batch_name, job_type, settings, batch_size=None, n_jobs=None):
+        """Submit a batch in shards of at most batch_size jobs (defaults to BATCH_SIZE), in parallel.
+        settings: the same dict as submit_batch(), containing "settings" and "jobNames" lists.
+        Shards are named batch_name, batch_name__2, batch_name__3, ..., get_batch_jobs(), monitor_batch(),
+        get_batch_results() and delete_batch() treat them as one batch.
+
+        return list of shard names
+        """
+        batch_size=batch_size or BATCH_SIZE
+        n=len(settings["jobNames"])
+        S_shard=[shard_name(batch_name, i) for i in range(max((n+batch_size-1)//batch_size, 1))]
+        self.c_shards[batch_name]=S_shard
+        if len(S_shard)==1:
+            self.submit_batch(batch_name, job_type, settings)
+            return S_shard
+        def submit(i):
+            one={**settings, "settings": settings["settings"][i*batch_size:(i+1)*batch_size],
+                "jobNames": settings["jobNames"][i*batch_size:(i+1)*batch_size]}
+            self.submit_batch(S_shard[i], job_type, one)
+            pg.update(1)
+        pg=tqdm.tqdm(total=len(S_shard), position=0, desc="Submit")
+        failed=parallel(submit, range(len(S_shard)), n_jobs or SUBMIT_WORKERS)
+        pg.close()
+        if len(failed):
+            raise Exception(f"{len(failed)} of {len(S_shard)} shards of batch {batch_name} cannot be created! "+
+                "; ".join(f"{S_shard[i]}: {v}" for i,v in sorted(failed.items())[:3]))
+        return S_shard
+
+    def submit_stream(self, batch_name, job_type, chunks, batch_size=None, n_jobs=None, output_folder=None):
+        """Submit a batch given as an iterable of settings dicts (as in submit_batch()), e.g., built from chunks
+        of a huge input file. Each chunk becomes one shard (chunks above batch_size jobs, defaults to BATCH_SIZE,
+        are split), named as in submit_batches(). Shards are submitted by n_jobs threads (defaults to SUBMIT_WORKERS)
+        while the next chunk is built, and no more than n_jobs chunks are held at a time, so memory is bounded
+        by the chunk size. No more chunks are read after a shard fails.
+        output_folder: if set, recorded in the ledger for submitted jobs
+
+        return list of shard names, empty if all chunks were empty
+        """
+        batch_size=batch_size or BATCH_SIZE
+        n_jobs=n_jobs or SUBMIT_WORKERS
+        S_shard=[]
+        self.c_shards[batch_name]=S_shard
+        failed={}
+        slots=threading.Semaphore(n_jobs)
+        def submit(name, one):
+            try:
+                self.submit_batch(name, job_type, one)
+                if output_folder is not None:
+                    self.ledger.set_batch_folder([name], output_folder)
+                pg.update(len(one["jobNames"]))
+            except Exception as e:
+                failed[name]=str(e)
+            finally:
+                slots.release()
+        pg=tqdm.tqdm(position=0, desc="Submit", unit="job")
+        try:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                for settings in chunks:
+                    n=len(settings["jobNames"])
+                    for i in range(0, n, batch_size):
+                        one={**settings, "settings": settings["settings"][i:i+batch_size], "jobNames": settings["jobNames"][i:i+batch_size]}
+                        slots.acquire()
+                        if len(failed):
+                            slots.release()
+                            break
+                        S_shard.append(shard_name(batch_name, len(S_shard)))
+                        pool.submit(submit, S_shard[-1], one)
+                    if len(failed): break
+        finally:
+            pg.close()
+        if len(failed):
+            raise Exception(f"{len(failed)} of {len(S_shard)} shards of batch {batch_name} cannot be created! "+
+                "; ".join(f"{k}: {v}" for k,v in sorted(failed.items())[:3]))
+        return S_shard
+
+    def settings_key(self, job_type, settings):
+        """Content address of a job: hash of job_type and settings, where files uploaded by this object are
+        replaced by their content hash, so the same template uploaded into different batch folders gives the same key
+        """
+        c_hash={v:k[1] for k,v in self.c_uploaded.items()}
+        def canonical(x):
+            if isinstance(x, str): return "sha256:"+c_hash[x] if x in c_hash else x
+            if isinstance(x, (list, tuple)): return [canonical(v) for v in x]
+            if isinstance(x, dict): return {k:canonical(v) for k,v in x.items()}
+            return x
+        return settings_hash({"type": job_type, "settings": canonical(settings)})
+
+    def dedup_batch(self, job_type, settings, output_folder=".", n_jobs=None):
+        """Serve jobs of a batch from completed earlier jobs with the same settings_key(), as recorded in the ledger
+        and confirmed by a job listing. Their results are copied from the earlier download folder if it is still there,
+        otherwise downloaded again (unless the earlier job was deleted),
+        into the job folder within output_folder, as if the job was submitted.
+        settings: dict as in submit_batch(), containing "settings" and "jobNames" lists
+        n_jobs: number of parallel downloads, defaults to DOWNLOAD_WORKERS
+
+        return settings restricted to the jobs that still need to be submitted
+        """
+        S_name=settings["jobNames"]
+        S_key=[self.settings_key(job_type, x) for x in settings["settings"]]
+        c_hit=self.ledger.find(job_type, S_key)
+        def serve(i):
+            dst=os.path.join(output_folder, job_folder(S_name[i]))
+            for old, folder, downloaded, deleted in c_hit[S_key[i]]:
+                src=os.path.join(folder, job_folder(old)) if folder else None
+                if downloaded and src and os.path.isdir(src):
+                    if os.path.abspath(src)!=os.path.abspath(dst):
+                        shutil.copytree(src, dst, dirs_exist_ok=True)
+                    return
+                if deleted: continue
+                # download into a scratch folder, as the earlier job folder may clash with a job in this batch
+                tmp=os.path.join(output_folder, f".dedup.{S_name[i]}")
+                if self.get_results(old, tmp, force=True).startswith("Downloaded"):
+                    self.ledger.set_folder([old], None)
+                    if os.path.exists(dst): shutil.rmtree(dst)
+                    os.replace(os.path.join(tmp, job_folder(old)), dst)
+                    shutil.rmtree(tmp)
+                    return
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise Exception("no earlier results are available")
+        S_hit=[i for i,k in enumerate(S_key) if k in c_hit]
+        failed=parallel(serve, S_hit, n_jobs or DOWNLOAD_WORKERS)
+        S_hit=[i for i in S_hit if i not in failed]
+        if len(S_hit):
+            print(f"{len(S_hit)} of {len(S_name)} jobs are served from earlier results: "+", ".join(S_name[i] for i in S_hit[:5]))
+        S_hit=set(S_hit)
+        return {**settings, "settings": [x for i,x in enumerate(settings["settings"]) if i not in S_hit],
+            "jobNames": [x for i,x in enumerate(S_name) if i not in S_hit]}
+
+    def batch_shards(self, batch_name, listing=None):
+        """Names of all shards of a batch, see submit_batches()
+        listing: names of all top-level jobs, as from get_jobs(expand_batch=False). Shards are top-level entries,
+            so they are taken from it, instead of asking the API for batch_name__2, batch_name__3, ... one by one
+        """
+        if batch_name not in self.c_shards:
+            S_shard=[batch_name]
+            # a shard itself has no shards
+            if not is_shard(batch_name):
+                exists=(lambda x: x in listing) if listing is not None else (lambda x: len(self.get_jobs(job_name=x))>0)
+                while exists(shard_name(batch_name, len(S_shard))):
+                    S_shard.append(shard_name(batch_name, len(S_shard)))
+            self.c_shards[batch_name]=S_shard
+        return self.c_shards[batch_name]
+
     def upload_file(self, local_filepath, uploaded_filename, folder=None):
         """Upload a local file to cloud, optionally under a user-specified folder."""
         endpoint = f"upload/{uploaded_filename}"
@@ -59,155 +550,240 @@ class JobManagement:
         if folder is not None:
             params["folder"] = folder
         with open(local_filepath, 'rb') as file_data:
-            response = requests.put(self.base_url + endpoint, headers=self.headers, data=file_data, params=params)
+            response = self._request("PUT", endpoint, data=file_data, params=params)
         return response.status_code
 
-    def upload_batch(self, batch_name, S_local_filepath, empty_first=True):
+    def upload_batch(self, batch_name, S_local_filepath, empty_first=True, n_jobs=None):
         """Create a folder named [batch_name], and place multiple local files inside
-        If folder is not specified, they are placed into root folder.
-        Redudant local files will only be uploaded once.
+        If batch_name is None, they are placed into root folder.
+        Files are deduplicated by content (SHA-256), so identical files under different paths are uploaded once.
+        Files this object uploaded before into the same folder, and still there, are not uploaded again.
 
-        empty_first: if True, delete existing remote files in the folder
+        empty_first: if True, delete existing remote files in the folder (never applies to the root folder)
+        n_jobs: number of parallel uploads, defaults to UPLOAD_WORKERS
 
         return dict mapping the local file name to the remote file path
         """
+        n_jobs=n_jobs or UPLOAD_WORKERS
+        S_local=sorted({x for x in S_local_filepath if pd.notnull(x) and x!=''})
         uploaded=set()
-        c_upload={}
-        if empty_first:
-            self.delete_batch_files(batch_name)
-        else:
-            uploaded=set(self.get_files(folder = batch_name))
-        for x in set(S_local_filepath):
-            if pd.isnull(x) or x=='': continue
-            fn, ext = os.path.splitext(os.path.basename(x))
-            name = fn+ext
-            full_name=os.path.join(batch_name, name)
-            i=2
-            while full_name in uploaded:
-                name= fn+str(i)+ext
-                full_name=os.path.join(batch_name, name)
-                i+=1
-            self.upload_file(x, name, folder=batch_name)
-            c_upload[x]=full_name
-            uploaded.add(full_name)
+        if batch_name is not None:
+            if empty_first:
+                self.delete_batch_files(batch_name)
+                self.c_uploaded={k:v for k,v in self.c_uploaded.items() if k[0]!=batch_name}
+            else:
+                uploaded=set(self.get_files(folder = batch_name))
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            S_hash=list(pool.map(file_hash, S_local))
+        c_upload, c_remote, c_todo=plan_uploads(batch_name, S_local, S_hash, self.c_uploaded, uploaded)
+        def upload(full_name):
+            status=self.upload_file(c_todo[full_name], os.path.basename(full_name), folder=batch_name)
+            if status//100!=2:
+                raise Exception(f"upload failed with status {status}")
+        failed=parallel(upload, list(c_todo), n_jobs)
+        if len(failed):
+            raise Exception(f"{len(failed)} files cannot be uploaded: "+", ".join(c_todo[x] for x in sorted(failed)[:5]))
+        for h,full_name in c_remote.items():
+            self.c_uploaded[(batch_name, h)]=full_name
         if DEBUG:
             print("Uploading files: ", c_upload)
         return c_upload
 
     def is_batch(self, job_name):
         """Check if a job_name is a job name or a batch name"""
-        t=get_jobs(job_name=job_name)
+        t=self.get_jobs(job_name=job_name)
         if len(t)==0:
             raise Exception(f"Job {job_name} is not found!")
         return dict(t.iloc[0])['Type']=='batch'
 
-    def get_jobs(self, **kw):
+    def _pages(self, params, warn=None):
+        """Generator over the pages of the jobs endpoint, yields (records, is_last_page).
+        A page is only requested once the previous one is consumed.
+        warn: message printed if the request fails, the generator then stops
+        """
+        params=dict(params)
+        while True:
+            response = self._request("GET", "jobs", params=params)
+            if response.status_code!=200:
+                if warn: print(warn)
+                if DEBUG: print(response.text)
+                return
+            jobs_json=response.json()
+            if DEBUG: print(jobs_json)
+            last='startKey' not in jobs_json
+            yield page_jobs(jobs_json), last
+            if last: return
+            # more pages
+            params['startKey']=jobs_json['startKey']
+
+    def iter_jobs(self, job_name=None, expand_batch=False, organization=False, job_type=None, status=None, prefix=None, created_after=None, pages=False):
+        """Lazily iterate over job records (dict), pages are fetched as the caller consumes them,
+        so memory is proportional to one page and the caller can stop early.
+
+        job_name, expand_batch, organization: as in get_jobs, sent to the API
+        job_type: restricted to job_type (Model), batch entries are matched by the model in their Settings
+        status: a JobStatus or a list of them, e.g., "Running"
+        prefix: only job names starting with prefix
+        created_after: only jobs created after this time, str or datetime
+        pages: if True, yield one list of records per page instead of individual records
+
+        The jobs endpoint only filters by jobName, other filters are applied to each page as it arrives.
+        """
+        params=job_params(job_name, expand_batch, organization)
+        keep=job_filter(job_type, status, prefix, created_after)
+        for out,last in self._pages(params):
+            out=keep(out)
+            if pages:
+                if len(out): yield out
+            else:
+                yield from out
+
+    def get_jobs(self, cache=True, **kw):
         """Get a dataframe containing job entries
 
         job_name: default None means all jobs
         expand_batch: default False means return a batch job as one single entry, otherwise, return underlying jobs
         organization: default False means only return own jobs
         job_type: restricted to job_type
+        status, prefix, created_after: additional filters, see iter_jobs
+        cache: if True, reuse a listing fetched within the last CACHE_TTL seconds, see JobCache.
+            Monitors use False, as they need the latest status
         """
-        opt={"job_name": None, "expand_batch": False, "organization": False, "job_type": None}
+        opt={"job_name": None, "expand_batch": False, "organization": False, "job_type": None,
+            "status": None, "prefix": None, "created_after": None}
         if kw is not None:
             opt.update(kw)
-        endpoint = "jobs"
-        params={}
-        if opt['job_name'] is not None:
-            params['jobName']=opt['job_name']
-        if opt['organization']:
-            params['organization']=True
-        if opt['expand_batch']:
-            params['includeSubjobs']="true"
+        params=job_params(opt['job_name'], opt['expand_batch'], opt['organization'])
+        keep=job_filter(None, opt['status'], opt['prefix'], opt['created_after'])
+        out=self.cache.get(params) if cache else None
+        if out is not None:
+            return jobs_frame(keep(out), opt['job_type'])
         out=[]
-        while True:
-            response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
-            if response.status_code!=200:
-                if DEBUG: print(response.text)
-                break
-            jobs_json=response.json()
-            if DEBUG: print(jobs_json)
+        complete=False
+        for page,last in self._pages(params):
+            out.extend(page)
+            # only cache complete listings
+            if last: self.cache.put(params, out)
+            complete=last
+        if not opt['organization']:
+            self.ledger.sync(out, full=complete and opt['job_name'] is None, expand_batch=opt['expand_batch'])
+        return jobs_frame(keep(out), opt['job_type'])
 
-            if 'jobs' in jobs_json:
-                out.extend(jobs_json['jobs'])
-            elif '0' in jobs_json:
-                out.append(jobs_json['0'])
-            if 'startKey' not in jobs_json:
-                break
-            # more pages
-            params['startKey']=jobs_json['startKey']
-        if len(out)==0:
-            jobs_df=pd.DataFrame([], columns=['Score','JobName','JobStatus','Type','Settings','Created','Model','Batch'])
-            return jobs_df
-        else:
-            jobs_df=pd.DataFrame(out)
-            jobs_df['Model']=jobs_df.apply(lambda r: r.Settings if r.Type=='batch' else r.Type, axis=1)
-        if opt['job_type']:
-            x=opt['job_type']
-            jobs_df=jobs_df[jobs_df.Model==x].copy()
-        if 'Batch' not in jobs_df.columns:
-            jobs_df['Batch']=jobs_df.apply(lambda r: r.JobName if r.Type=='batch' else None, axis=1)
-        else: # expanded, let's remove the batch entry
-            jobs_df=jobs_df[jobs_df.Type!='batch'].copy()
-        return jobs_df
+    def sync_ledger(self, max_age=None, n_jobs=None):
+        """Bring self.ledger up to date with as few API calls as possible.
+        All jobs are listed, if the last full listing is older than max_age seconds (defaults to LEDGER_SYNC),
+        otherwise only jobs the ledger has as unfinished are fetched, batches with get_batch_jobs().
+        n_jobs: number of parallel requests, defaults to READ_WORKERS
+        """
+        max_age=LEDGER_SYNC if max_age is None else max_age
+        t=self.ledger.last_full_sync()
+        if self.ledger.db is None or t is None or time.time()-t>max_age:
+            self.get_jobs(expand_batch=True, cache=False)
+            return
+        active=self.ledger.records(expand_batch=True, unfinished=True)
+        S_batch=list({r['Batch'] for r in active if 'Batch' in r})
+        S_job=[r['JobName'] for r in active if 'Batch' not in r]
+        if len(S_batch)+len(S_job)>LEDGER_DELTA:
+            self.get_jobs(expand_batch=True, cache=False)
+            return
+        def fetch_job(job_name):
+            if len(self.get_jobs(job_name=job_name, cache=False))==0:
+                self.ledger.remove([job_name])
+        parallel(self.get_batch_jobs, S_batch, n_jobs or READ_WORKERS)
+        parallel(fetch_job, S_job, n_jobs or READ_WORKERS)
 
     def get_batch_jobs(self, batch_name):
-        """Get all jobs listed under a batch submission"""
-        endpoint = "jobs"
-        params={"batch": batch_name}
+        """Get all jobs listed under a batch submission, jobs in all its shards are included"""
+        T=[self.get_shard_jobs(x) for x in self.batch_shards(batch_name)]
+        return T[0] if len(T)==1 else pd.concat(T, ignore_index=True)
+
+    def get_shard_jobs(self, batch_name):
+        """Get jobs listed under one submit-batch request"""
         out=[]
-        while True:
-            response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
-            if response.status_code != 200:
-                print(f"Warning: no job found under batch {batch_name}")
-                if DEBUG: print(response.text)
-                break
-            jobs_json=response.json()
-            if DEBUG: print(jobs_json)
-            if 'jobs' in jobs_json:
-                out.extend(jobs_json['jobs'])
-            elif '0' in jobs_json:
-                out.append(jobs_json['0'])
-            if 'startKey' not in jobs_json:
-                break
-            params['startKey']=jobs_json['startKey']
-        if len(out)==0:
-            jobs_df=pd.DataFrame([], columns=['Score','JobName','JobStatus','Type','Settings','Created','Batch'])
-        else:
-            jobs_df=pd.DataFrame(out)
-        return jobs_df
+        for page,last in self._pages({"batch": batch_name}, warn=f"Warning: no job found under batch {batch_name}"):
+            out.extend(page)
+        self.ledger.sync(out, batch=batch_name)
+        return batch_jobs_frame(out)
 
-    def delete_job(self, job_name):
+    def delete_job(self, job_name, verbose=True):
         """Delete a job entry"""
         endpoint = "delete-job"
         params = {"jobName": job_name}
-        response = requests.post(self.base_url + endpoint, headers=self.headers, json=params)
-        print(f"Job deleted: {job_name}")
+        response = self._request("POST", endpoint, json=params)
+        self.cache.invalidate()
         if DEBUG: print(response.text)
+        if response.status_code!=200:
+            raise Exception(f"Job {job_name} cannot be deleted! "+response.text)
+        self.ledger.remove([job_name])
+        if verbose: print(f"Job deleted: {job_name}")
         return response.text
 
-    def delete_batch(self, batch_name):
+    def delete_jobs(self, job_names, n_jobs=None, dry_run=False):
+        """Delete job entries in parallel, at most DELETE_RATE requests per second.
+        Prints a summary instead of one line per job.
+        n_jobs: number of parallel requests, defaults to DELETE_WORKERS
+        dry_run: only list the jobs that would be deleted
+
+        return dict mapping job names that failed to error messages
+        """
+        if dry_run:
+            print(f"Dry run, {len(job_names)} jobs would be deleted:")
+            print("\n".join("    "+x for x in job_names))
+            return {}
+        failed=parallel(lambda x: self.delete_job(x, verbose=False), job_names, n_jobs or DELETE_WORKERS, rate=DELETE_RATE)
+        report(f"Deleted {len(job_names)-len(failed)} jobs", failed)
+        return failed
+
+    def delete_batch(self, batch_name, n_jobs=None, dry_run=False):
         """Delete all jobs under a batch"""
-        t=self.get_batch_jobs(batch_name)
+        return self.delete_batches([batch_name], n_jobs=n_jobs, dry_run=dry_run)
+
+    def delete_batches(self, batch_names, n_jobs=None, dry_run=False, listing=None):
+        """Delete batches, including all their jobs and uploaded files.
+        Sub jobs of all batches are deleted in parallel, then the batch entries.
+        n_jobs: number of parallel requests, defaults to DELETE_WORKERS
+        dry_run: only list the batches and the number of their jobs
+        listing: names of all top-level jobs if the caller has them, shards are found there, see batch_shards()
+
+        return dict mapping job/batch names that failed to error messages
+        """
+        n_jobs=n_jobs or DELETE_WORKERS
+        # shards listed along with their batch are covered by the batch
+        c_seen=set(batch_names)
+        batch_names=[x for x in batch_names if not (is_shard(x) and shard_base(x) in c_seen)]
+        if len(batch_names)==0: return {}
+        listing=None if listing is None else set(listing)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            S_shard=[x for S in pool.map(lambda b: self.batch_shards(b, listing), batch_names) for x in S]
+            T=list(pool.map(self.get_batch_jobs, batch_names))
+        S_job=[x for t in T for x in t.JobName]
+        if dry_run:
+            print(f"Dry run, {len(batch_names)} batches with {len(S_job)} jobs would be deleted:")
+            for batch_name,t in zip(batch_names, T):
+                print(f"    {batch_name}/* ({len(t)} jobs)")
+            return {}
         # delete all uploaded files
-        self.delete_batch_files(batch_name)
-        for i,r in t.iterrows():
-            self.delete_job(r['JobName'])
-        self.delete_job(batch_name)
-        print(f"Batch deleted: {batch_name}")
+        failed=parallel(self.delete_batch_files, S_shard, n_jobs, rate=DELETE_RATE)
+        failed.update(self.delete_jobs(S_job, n_jobs))
+        failed_batch=parallel(lambda x: self.delete_job(x, verbose=False), S_shard, n_jobs, rate=DELETE_RATE)
+        report(f"Batches deleted: {len(S_shard)-len(failed_batch)}", failed_batch)
+        for x in batch_names:
+            self.c_shards.pop(x, None)
+        failed.update(failed_batch)
+        return failed
 
-    def delete_all_jobs(self, **kw):
+    def delete_all_jobs(self, n_jobs=None, dry_run=False, **kw):
         """Delete all jobs.
+           n_jobs, dry_run: see delete_jobs()
            kw takes the same values as the method get_jobs(), i.e., job_name, expand_batch, organization, job_type
         """
         kw['expand_batch'] = False
         t=self.get_jobs(**kw)
-        for i,r in t.iterrows():
-            if r['Type']=='batch':
-                self.delete_batch(r['JobName'])
-            else:
-                self.delete_job(r['JobName'])
+        # a listing filtered by job_name does not show the shards
+        listing=None if kw.get('job_name') is not None else t.JobName
+        self.delete_batches(t[t.Type=='batch'].JobName.tolist(), n_jobs=n_jobs, dry_run=dry_run, listing=listing)
+        self.delete_jobs(t[t.Type!='batch'].JobName.tolist(), n_jobs=n_jobs, dry_run=dry_run)
+        if dry_run: return True
         t=self.get_jobs(**kw)
         if len(t)==0:
             print("All jobs have been deleted successfully.")
@@ -216,46 +792,102 @@ class JobManagement:
             print(f"{len(t)} jobs cannot be deleted: "+", ".join(t[:5].JobName.tolist()))
             return False
 
-    def get_results(self, job_name, output_folder="."):
+    def get_results(self, job_name, output_folder=".", progress=False, force=False):
         """Save job output into output_folder
         jobs_name: use get_batch_results, if you have a batch_name
         output_folder: output folder name, defaults to the current folder
+        progress: True to show a byte progress bar, or a callable that receives the number of bytes downloaded
+        force: download again, even if the output_folder manifest says the job was downloaded
+
+        An interrupted download is resumed with an HTTP Range request, if the server supports it.
         """
+        manifest=Manifest.open(output_folder)
+        if not force and manifest.is_done(job_name):
+            return f"Skipped, results already in: {os.path.join(output_folder, manifest.get(job_name)['folder'])}"
         endpoint = "result"
         params = {"jobName": job_name}
-        response = requests.post(self.base_url + endpoint, headers=self.headers, json=params)
+        response = self._request("POST", endpoint, json=params)
         if response.status_code == 200:
             if DEBUG: print(response.text)
             results_url = response.text.replace('"', '')
-            results_response = requests.get(results_url, proxies=proxies)
-            if results_response.status_code == 200:
-                # when the sequence name appears before in other batches, Tamarind adds batch name as prefix
-                # we prefer to remove that
-                job_name=re.sub(r'[^\-]+-', '', job_name)
-                fout=os.path.join(output_folder, job_name)
-                os.makedirs(fout, exist_ok=True)
-                save_path = os.path.join(fout, "result.zip")
-                with open(save_path, 'wb') as file:
-                    file.write(results_response.content)
-                with zipfile.ZipFile(save_path, "r") as zip_file:
-                    zip_file.extractall(fout)
-                os.remove(save_path)
-                return f"Downloaded and unpack results into: {fout}"
-            else:
-                return f"Failed to download results: {results_response.status_code}"
+            folder=job_folder(job_name)
+            fout=os.path.join(output_folder, folder)
+            os.makedirs(fout, exist_ok=True)
+            save_path = os.path.join(fout, "result.zip")
+            headers={}
+            etag=manifest.get(job_name).get('etag')
+            if not force and etag is not None and os.path.exists(save_path):
+                # partial archive left by an interrupted run, If-Range makes the server send
+                # the whole file instead, if the archive has changed since
+                headers={'Range': f"bytes={os.path.getsize(save_path)}-", 'If-Range': etag}
+            # stream the archive to disk, so memory use does not grow with the archive size
+            t0=time.perf_counter()
+            with self.session.get(results_url, headers=headers, proxies=proxies, timeout=self.timeout, stream=True) as results_response:
+                if results_response.status_code not in (200, 206):
+                    if self.metrics: self.metrics.record("download", results_response.status_code, time.perf_counter()-t0)
+                    return f"Failed to download results: {results_response.status_code}"
+                manifest.update(job_name, folder=folder, etag=results_response.headers.get('ETag'), completed=None)
+                offset=os.path.getsize(save_path) if results_response.status_code==206 else 0
+                save_stream(results_response, save_path, progress, append=results_response.status_code==206)
+            size=os.path.getsize(save_path)
+            if self.metrics: self.metrics.record("download", results_response.status_code, time.perf_counter()-t0, bytes_in=size-offset)
+            # zip needs its central directory at the end, so we extract once the file is complete,
+            # members are extracted one at a time
+            with zipfile.ZipFile(save_path, "r") as zip_file:
+                zip_file.extractall(fout)
+            os.remove(save_path)
+            manifest.update(job_name, size=size, completed=time.strftime("%Y-%m-%d %H:%M:%S"))
+            self.ledger.set_folder([job_name], output_folder, downloaded=True)
+            return f"Downloaded and unpack results into: {fout}"
         else:
             if DEBUG: print(response.text)
             return f"Failed to retrieve results URL: {response.status_code}"
 
-    def get_batch_results(self, batch_name, output_folder="."):
-        """Save all job outputs into output_folder, each job entry has its own subfolder"""
+    def get_batch_results(self, batch_name, output_folder=".", n_jobs=None, force=False):
+        """Save all job outputs into output_folder, each job entry has its own subfolder
+        n_jobs: number of parallel downloads, defaults to DOWNLOAD_WORKERS
+        force: download again jobs that are already downloaded
+
+        return dict mapping failed job names to error messages
+        """
         t=self.get_batch_jobs(batch_name)
         output_folder=os.path.join(output_folder, batch_name)
-        if len(t)==0: return
-        pg=tqdm.tqdm(total=len(t), position=0)
-        for i,r in t.iterrows():
-            self.get_results(r['JobName'], output_folder=output_folder)
-            pg.update(1)
+        if len(t)==0: return {}
+        return self.download_jobs(t.JobName.tolist(), output_folder, n_jobs=n_jobs, force=force)
+
+    def download_jobs(self, job_names, output_folder=".", n_jobs=None, force=False):
+        """Download results of multiple jobs in parallel, each job entry has its own subfolder.
+        A failed job does not stop the others, failures are reported at the end.
+        n_jobs: number of parallel downloads, defaults to DOWNLOAD_WORKERS
+        force: download again jobs that are already downloaded
+
+        return dict mapping failed job names to error messages
+        """
+        failed={}
+        if len(job_names)==0: return failed
+        pg=tqdm.tqdm(total=len(job_names), position=0)
+        received=[0]
+        def count_bytes(n):
+            # += on a list item is good enough for a progress display
+            received[0]+=n
+        with ThreadPoolExecutor(max_workers=n_jobs or DOWNLOAD_WORKERS) as pool:
+            tasks={pool.submit(self.get_results, x, output_folder, count_bytes, force): x for x in job_names}
+            for task in as_completed(tasks):
+                job_name=tasks[task]
+                try:
+                    msg=task.result()
+                    if msg.startswith("Failed"):
+                        failed[job_name]=msg
+                except Exception as e:
+                    failed[job_name]=str(e)
+                pg.update(1)
+                pg.set_postfix(MB=f"{received[0]/1e6:.1f}", failed=len(failed))
+        pg.close()
+        if len(failed):
+            print(f"WARNING> {len(failed)} of {len(job_names)} downloads failed:")
+            for k,v in sorted(failed.items()):
+                print(f"    {k}: {v}")
+        return failed
 
     def get_files(self, folder=None):
         """Get a list of files from root, or a specific folder"""
@@ -263,7 +895,7 @@ class JobManagement:
         params = {}
         if folder is not None:
             params["folder"] = folder
-        response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
+        response = self._request("GET", endpoint, params=params)
         if DEBUG: print(response.text)
         return response.json()
 
@@ -271,7 +903,7 @@ class JobManagement:
         """Get a list of all files, including files under folders"""
         endpoint = "files"
         params = {"includeFolders": "true"}
-        response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
+        response = self._request("GET", endpoint, params=params)
         if DEBUG: print(response.text)
         return response.json()
 
@@ -279,7 +911,7 @@ class JobManagement:
         """Delete a specific file"""
         endpoint = "delete-file"
         params = { "filePath": file_path }
-        response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
+        response = self._request("GET", endpoint, params=params)
         if DEBUG: print(response.text)
         return response.json()
 
@@ -287,17 +919,32 @@ class JobManagement:
         """Delete all files under a folder named batch_name"""
         endpoint = "delete-file"
         params = { "folder": batch_name}
-        response = requests.get(self.base_url + endpoint, headers=self.headers, params=params)
+        response = self._request("GET", endpoint, params=params)
         if DEBUG: print(response.text)
         return response.json()
 
-    def delete_all_files(self):
-        """Delete all files uploaded by user"""
-        for file_name in self.get_all_files():
+    def delete_files(self, file_names, n_jobs=None, dry_run=False):
+        """Delete files in parallel, names ending with "/" are folders.
+        n_jobs, dry_run: see delete_jobs()
+
+        return dict mapping file names that failed to error messages
+        """
+        if dry_run:
+            print(f"Dry run, {len(file_names)} files & folders would be deleted:")
+            print("\n".join("    "+x for x in file_names))
+            return {}
+        def delete(file_name):
             if file_name.endswith("/"): # a folder
                 self.delete_batch_files(file_name[:-1])
             else:
                 self.delete_file(file_name)
+        failed=parallel(delete, file_names, n_jobs or DELETE_WORKERS, rate=DELETE_RATE)
+        report(f"Deleted {len(file_names)-len(failed)} files & folders", failed)
+        return failed
+
+    def delete_all_files(self, n_jobs=None, dry_run=False):
+        """Delete all files uploaded by user"""
+        return self.delete_files(self.get_all_files(), n_jobs=n_jobs, dry_run=dry_run)
 
     def monitor(self, job_name, output_folder=".", skip_download=False):
         """Check the status of a job, waits till it is completed. Then save results to the output_folder.
@@ -308,10 +955,12 @@ class JobManagement:
         N=5
         n=0
         pg=tqdm.tqdm(total=N, position=0)
+        sched=PollScheduler()
         while True:
-            t=self.get_jobs(job_name=job_name)
+            t=self.get_jobs(job_name=job_name, cache=False)
             if len(t)==0:
                 raise Exception(f"Job {job_name} is missing!")
+            sched.update(t.to_dict('records'))
             status=t.loc[0, 'JobStatus']
             #status='Running'
             n+=1
@@ -330,7 +979,7 @@ class JobManagement:
                     pg.refresh()
             pg.update(1)
             pg.set_description(status)
-            time.sleep(MONITOR_INTERVAL)
+            sched.wait()
 
 
     def monitor_all(self, job_type=None, job_names=None, expand_batch=True, output_folder=".", skip_download=False):
@@ -338,18 +987,17 @@ class JobManagement:
         job_type: jobs with certain job_type, default None - means any
         job_names: a list of job names
         expand_batch: include jobs within batches, True as the default
-        """
 
-        if job_names is not None:
-            job_names=set(job_names)
+        Only the first poll lists all jobs, later polls only fetch unfinished jobs, see JobWatcher
+        """
+        watcher=JobWatcher(self, job_type=job_type, job_names=job_names, expand_batch=expand_batch)
+        sched=PollScheduler()
         pg=None
-        c_downloaded=set()
         while True:
-            t=self.get_jobs(job_type=job_type, expand_batch=expand_batch)
-            if job_names is not None:
-                t=t[t.JobName.isin(job_names)]
-            N=len(t)
-            n=len(t[t.JobStatus.isin(('Complete','Stopped'))])
+            events=watcher.poll()
+            sched.update(watcher.state.values())
+            N=len(watcher.state)
+            n=watcher.n_final()
             if pg is None:
                 pg=tqdm.tqdm(total=N, position=0)
             else:
@@ -358,52 +1006,454 @@ class JobManagement:
                     pg.refresh()
             pg.update(max(n-pg.n, 0))
             if not skip_download:
-                t_new=t[(t.JobStatus=='Complete') & (t.JobName.notin(c_downloaded))]
-                for i,r in t_new.iterrows():
-                    self.get_results(r['JobName'], output_folder)
-                    c_downloaded.add(r['JobName'])
-            if N==n:
+                for job_name, old, new in events:
+                    if new=='Complete':
+                        self.get_results(job_name, output_folder)
+            if watcher.is_done():
                 del pg
-                print({k:len(t_v) for k,t_v in t.groupby('JobStatus')})
+                print(dict(watcher.counts))
                 break
-            time.sleep(MONITOR_INTERVAL)
+            sched.wait(watcher.n_request)
 
-    def monitor_batch(self, batch_name, output_folder=".", skip_download=False):
-        """Monitor all jobs within a batch, save output to output_folder"""
+    def watch(self, job_type=None, job_names=None, expand_batch=True):
+        """Generator of job status changes (job_name, old_status, new_status), until all jobs are finished.
+        old_status is None when a job is first seen, new_status is None when a job disappears.
+        Arguments are the same as monitor_all()
+        """
+        watcher=JobWatcher(self, job_type=job_type, job_names=job_names, expand_batch=expand_batch)
+        sched=PollScheduler()
+        while True:
+            events=watcher.poll()
+            sched.update(watcher.state.values())
+            yield from events
+            if watcher.is_done(): break
+            sched.wait(watcher.n_request)
+
+    def monitor_batch(self, batch_name, output_folder=".", skip_download=False, callback=None, n_jobs=None):
+        """Monitor all jobs within a batch, save output to output_folder
+        callback: optional function called with a list of job names whose results just landed, e.g.,
+            to update results.csv as jobs finish
+        n_jobs: number of parallel downloads, defaults to DOWNLOAD_WORKERS
+
+        Runs as a pipeline: this thread polls and queues completed jobs, a pool of threads downloads them,
+        and another thread passes downloaded jobs to callback, all the jobs that landed since its last call at once.
+        So polling never waits for downloads, and results.csv is current soon after the last job completes.
+        Stages are connected by queues of at most PIPELINE_QUEUE jobs.
+        If polling fails or is interrupted (Ctrl-C), downloads already running are finished, queued ones are dropped.
+        """
+        n_jobs=n_jobs or DOWNLOAD_WORKERS
+        q_download=queue.Queue(PIPELINE_QUEUE)
+        q_done=queue.Queue(PIPELINE_QUEUE)
+        failed={}
+        stop=threading.Event()
+        def download():
+            while True:
+                job_name=q_download.get()
+                if job_name is None or stop.is_set(): break
+                try:
+                    msg=self.get_results(job_name, output_folder)
+                    if msg.startswith("Failed"):
+                        failed[job_name]=msg
+                    elif callback is not None:
+                        q_done.put(job_name)
+                except Exception as e:
+                    failed[job_name]=str(e)
+        def aggregate():
+            done=False
+            while not done:
+                S_new=[q_done.get()]
+                # coalesce jobs that landed while the last callback ran
+                while True:
+                    try:
+                        S_new.append(q_done.get_nowait())
+                    except queue.Empty:
+                        break
+                done=None in S_new
+                S_new=[x for x in S_new if x is not None]
+                if len(S_new):
+                    try:
+                        callback(S_new)
+                    except Exception as e:
+                        print(f"WARNING> callback failed: {e}")
+        workers=[]
+        if not skip_download:
+            workers=[threading.Thread(target=download, daemon=True) for i in range(n_jobs)]
+            if callback is not None:
+                aggregator=threading.Thread(target=aggregate, daemon=True)
+                aggregator.start()
+            for x in workers: x.start()
         pg=None
         c_downloaded=set()
+        sched=PollScheduler()
+        try:
+            while True:
+                t=self.get_batch_jobs(batch_name)
+                sched.update(t.to_dict('records'))
+                N=len(t)
+                n=len(t[t.JobStatus.isin(('Complete','Stopped'))])
+                if pg is None:
+                    pg=tqdm.tqdm(total=N, position=0)
+                else:
+                    if pg.total!=N:
+                        pg.total=N
+                        pg.refresh()
+                pg.update(max(n-pg.n,0))
+                if not skip_download:
+                    for x in t.JobName[t.JobStatus=='Complete']:
+                        if x not in c_downloaded:
+                            c_downloaded.add(x)
+                            q_download.put(x)
+                if N==n:
+                    del pg
+                    print({k:len(t_v) for k,t_v in t.groupby('JobStatus')})
+                    break
+                # get_batch_jobs() makes one call per shard
+                sched.wait(len(self.batch_shards(batch_name)))
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if stop.is_set():
+                # drop queued jobs, so there is room for the end markers
+                while True:
+                    try:
+                        q_download.get_nowait()
+                    except queue.Empty:
+                        break
+            for x in workers: q_download.put(None)
+            for x in workers: x.join()
+            if workers and callback is not None:
+                q_done.put(None)
+                aggregator.join()
+        if len(failed):
+            report(f"Downloaded {len(c_downloaded)-len(failed)} jobs", failed)
+        return failed
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled at rate tokens per second, holds at most burst tokens"""
+
+    def __init__(self, rate, burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.last=time.monotonic()
+        self.lock=threading.Lock()
+
+    def acquire(self, n=1):
+        """Take n tokens, block until they are available"""
+        n=min(n, self.burst)
         while True:
-            t=self.get_batch_jobs(batch_name)
-            N=len(t)
-            n=len(t[t.JobStatus.isin(('Complete','Stopped'))])
-            if pg is None:
-                pg=tqdm.tqdm(total=N, position=0)
-            else:
-                if pg.total!=N:
-                    pg.total=N
-                    pg.refresh()
-            pg.update(max(n-pg.n,0))
-            for i,r in t.iterrows():
-                if r['JobStatus']=='Complete' and r['JobName'] not in c_downloaded:
-                    if not skip_download:
-                        self.get_results(r['JobName'], output_folder)
-                        c_downloaded.add(r['JobName'])
-            if N==n:
-                del pg
-                print({k:len(t_v) for k,t_v in t.groupby('JobStatus')})
-                break
-            time.sleep(MONITOR_INTERVAL)
+            with self.lock:
+                now=time.monotonic()
+                self.tokens=min(self.burst, self.tokens+(now-self.last)*self.rate)
+                self.last=now
+                if self.tokens>=n:
+                    self.tokens-=n
+                    return
+                t_wait=(n-self.tokens)/self.rate
+            time.sleep(t_wait)
+
+class RateLimiter:
+    """Token bucket shared by all processes on the host: its state is kept in a small JSON file, which is
+    locked (flock) while a request takes a token. Refilled at rate tokens per second, holds at most burst tokens.
+    pause() stops all requests for a while, e.g., when the API answers 429 with Retry-After.
+    rate 0 disables the limiter. If the file cannot be opened (e.g., another user created it), the state
+    is kept in memory, so the limit only covers this process.
+    """
+    # limiters in this process, see pause_all()
+    _instances=weakref.WeakSet()
+    _lock=threading.Lock()
+
+    def __init__(self, rate, burst=None, path=None):
+        self.rate=rate
+        self.burst=burst or max(rate, 1)
+        self.path=path
+        # the state when there is no file
+        self.state=None if path else {}
+        RateLimiter._instances.add(self)
+
+    def _update(self, f):
+        """Call f(state, now) with the file locked, the state is written back afterwards"""
+        with RateLimiter._lock:
+            if self.state is None:
+                try:
+                    with open(self.path, 'a+') as fh:
+                        if fcntl is not None: fcntl.flock(fh, fcntl.LOCK_EX)
+                        fh.seek(0)
+                        try:
+                            state=json.loads(fh.read())
+                        except ValueError: # new file
+                            state={}
+                        out=self._apply(state, f)
+                        fh.seek(0)
+                        fh.truncate()
+                        fh.write(json.dumps(state))
+                        return out
+                except OSError as e:
+                    print(f"WARNING> cannot use {self.path} ({e}), the rate limit only covers this process")
+                    self.state={}
+            return self._apply(self.state, f)
+
+    def _apply(self, state, f):
+        now=time.time()
+        state['tokens']=min(self.burst, state.get('tokens', self.burst)+max(now-state.get('last', now), 0)*self.rate)
+        state['last']=now
+        return f(state, now)
+
+    def take(self, n=1):
+        """Take n tokens if available, without blocking. Return 0 if taken, otherwise seconds to wait before trying again"""
+        if self.rate<=0: return 0
+        n=min(n, self.burst)
+        def take(state, now):
+            if state.get('paused', 0)>now:
+                return state['paused']-now
+            if state['tokens']<n:
+                return (n-state['tokens'])/self.rate
+            state['tokens']-=n
+            # requests per second over the last minute, see utilization()
+            sec=str(int(now))
+            recent={k:v for k,v in state.get('recent', {}).items() if int(k)>now-60}
+            recent[sec]=recent.get(sec, 0)+n
+            state['recent']=recent
+            return 0
+        return self._update(take)
+
+    def acquire(self, n=1):
+        """Take n tokens, block until they are available"""
+        while True:
+            t_wait=self.take(n)
+            if t_wait<=0: return
+            time.sleep(t_wait)
+
+    def pause(self, seconds):
+        """No requests for the next seconds, in all processes"""
+        if self.rate<=0 or not seconds: return
+        def f(state, now):
+            state['paused']=max(state.get('paused', 0), now+seconds)
+        self._update(f)
+
+    @classmethod
+    def pause_all(cls, seconds):
+        for x in list(cls._instances):
+            x.pause(seconds)
+
+    def utilization(self):
+        """Host-wide usage: requests in the last minute, fraction of the rate used, tokens left,
+        seconds until a pause ends
+        """
+        if self.rate<=0: return {'rate': 0}
+        def f(state, now):
+            n=sum(v for k,v in state.get('recent', {}).items() if int(k)>now-60)
+            return {'rate': self.rate, 'requests': n, 'utilization': n/(self.rate*60),
+                'tokens': state['tokens'], 'paused': max(state.get('paused', 0)-now, 0)}
+        return self._update(f)
+
+def account_key(api_key, base_url):
+    """Short hash of the API key and server, names the per-account cache, ledger and rate limit"""
+    return hashlib.sha1((api_key+base_url).encode()).hexdigest()[:8]
+
+def host_limiter(account):
+    """The RateLimiter shared by all clients of an account on this host, see RATE_LIMIT"""
+    return RateLimiter(RATE_LIMIT, RATE_BURST, RATE_FILE or os.path.join(tempfile.gettempdir(), f"tamarind-rate-{account}.json"))
+
+class PollScheduler:
+    """Decide how long a monitor waits before its next poll.
+
+    Run times of jobs seen going from unfinished to Complete are learned per model (job_type),
+    shared by all monitors in the process. If some unfinished jobs have an estimate, the monitor
+    sleeps until the earliest expected completion. Otherwise (no estimate or jobs overdue), it starts
+    from MONITOR_INTERVAL and backs off by BACKOFF_RATE for every poll without a status change.
+    Intervals are kept within [MIN_INTERVAL, MAX_INTERVAL], and all polls draw from a process-wide
+    budget of POLL_BUDGET calls per minute (read when the first poll waits, or after POLL_BUDGET changed).
+    """
+    # job_type -> exponential moving average of run time in seconds
+    runtime={}
+    _budget=None
+    BACKOFF_RATE=1.5
+    _lock=threading.Lock()
+
+    def __init__(self, interval=None):
+        self.interval=interval or MONITOR_INTERVAL
+        # job name -> (status, job_type, time first seen unfinished)
+        self.jobs={}
+        self.eta=None
+
+    @staticmethod
+    def job_type(r):
+        x=r.get('Model')
+        return x if pd.notnull(x) else r.get('Type')
+
+    def update(self, records):
+        """records: job records (dicts with JobName, JobStatus, Type/Model) from the latest poll"""
+        now=time.time()
+        changed=False
+        self.eta=None
+        for r in records:
+            name, status=r['JobName'], r['JobStatus']
+            old=self.jobs.get(name)
+            if old is None:
+                changed=True
+                old=self.jobs[name]=(status, self.job_type(r), None if status in FINAL_STATUS else now)
+            elif old[0]!=status:
+                changed=True
+                self.jobs[name]=(status,)+old[1:]
+                if status=='Complete' and old[2] is not None:
+                    self.learn(old[1], now-old[2])
+            if status not in FINAL_STATUS and old[2] is not None:
+                t=PollScheduler.runtime.get(old[1])
+                if t is not None and t>now-old[2]:
+                    rest=t-(now-old[2])
+                    self.eta=rest if self.eta is None else min(self.eta, rest)
+        if changed or self.eta is not None:
+            self.interval=MONITOR_INTERVAL
+        else:
+            self.interval=min(self.interval*self.BACKOFF_RATE, MAX_INTERVAL)
+
+    @classmethod
+    def learn(cls, job_type, seconds, alpha=0.3):
+        with cls._lock:
+            t=cls.runtime.get(job_type)
+            cls.runtime[job_type]=seconds if t is None else alpha*seconds+(1-alpha)*t
+
+    @classmethod
+    def budget(cls):
+        """The process-wide TokenBucket for polls"""
+        with cls._lock:
+            if cls._budget is None or cls._budget.burst!=POLL_BUDGET:
+                cls._budget=TokenBucket(POLL_BUDGET/60, POLL_BUDGET)
+            return cls._budget
+
+    def next_interval(self):
+        t=self.interval if self.eta is None else self.eta
+        return min(max(t, MIN_INTERVAL), MAX_INTERVAL)
+
+    def wait(self, n_request=1):
+        """Sleep till the next poll, n_request: number of API calls the next poll will make"""
+        time.sleep(self.next_interval())
+        PollScheduler.budget().acquire(n_request)
+
+class JobWatcher:
+    """Keep a local table of job status, so that polling cost depends on the number of unfinished jobs,
+    not the number of jobs in the account.
+    The first poll lists all jobs. Later polls fetch unfinished batch jobs with get_batch_jobs
+    (one call per batch), and other unfinished jobs by name. All jobs are listed again every FULL_SYNC polls.
+    """
+
+    def __init__(self, jm, job_type=None, job_names=None, expand_batch=True, full_sync=None):
+        self.jm=jm
+        self.job_type=job_type
+        self.job_names=set(job_names) if job_names is not None else None
+        self.expand_batch=expand_batch
+        self.full_sync=full_sync or FULL_SYNC
+        # job name -> job record (dict)
+        self.state={}
+        self.counts=Counter()
+        self.n_poll=0
+        # number of API calls (not counting extra pages) made by the last poll
+        self.n_request=0
+
+    def n_final(self):
+        return sum(self.counts[x] for x in FINAL_STATUS)
+
+    def is_done(self):
+        return self.n_poll>0 and self.n_final()==len(self.state)
+
+    def _set(self, r, events):
+        name=r['JobName']
+        old=self.state.get(name, {}).get('JobStatus')
+        new=r['JobStatus']
+        if old is not None:
+            self.counts[old]-=1
+        self.counts[new]+=1
+        self.state[name]=r
+        if old!=new:
+            events.append((name, old, new))
+
+    def _remove(self, name, events):
+        r=self.state.pop(name)
+        self.counts[r['JobStatus']]-=1
+        events.append((name, r['JobStatus'], None))
+
+    def active(self):
+        """Return (batch names, job names) to fetch in the next incremental poll"""
+        active=[r for r in self.state.values() if r['JobStatus'] not in FINAL_STATUS]
+        S_batch={r['Batch'] for r in active if self.expand_batch and pd.notnull(r.get('Batch'))}
+        S_job=[r['JobName'] for r in active if not (self.expand_batch and pd.notnull(r.get('Batch')))]
+        return S_batch, S_job
+
+    def is_full_sync(self):
+        return self.n_poll % self.full_sync == 0
+
+    def apply_listing(self, t, events):
+        """t: dataframe returned by get_jobs() for all jobs"""
+        if self.job_names is not None:
+            t=t[t.JobName.isin(self.job_names)]
+        S_seen=set()
+        for r in t.to_dict('records'):
+            self._set(r, events)
+            S_seen.add(r['JobName'])
+        for name in [x for x in self.state if x not in S_seen]:
+            self._remove(name, events)
+
+    def apply_batch(self, t, events):
+        """t: dataframe returned by get_batch_jobs()"""
+        for r in t.to_dict('records'):
+            if r['JobName'] in self.state:
+                self._set({**self.state[r['JobName']], **r}, events)
+
+    def apply_job(self, job_name, t, events):
+        """t: dataframe returned by get_jobs(job_name=job_name)"""
+        if len(t)==0:
+            self._remove(job_name, events)
+        else:
+            self._set({**self.state[job_name], **t.to_dict('records')[0]}, events)
+
+    def poll(self):
+        """Fetch the latest status, return a list of (job_name, old_status, new_status) changes"""
+        events=[]
+        if self.is_full_sync():
+            self.n_request=1
+            self.apply_listing(self.jm.get_jobs(job_type=self.job_type, expand_batch=self.expand_batch, cache=False), events)
+        else:
+            S_batch, S_job=self.active()
+            self.n_request=len(S_batch)+len(S_job)
+            for batch_name in S_batch:
+                self.apply_batch(self.jm.get_batch_jobs(batch_name), events)
+            for job_name in S_job:
+                self.apply_job(job_name, self.jm.get_jobs(job_name=job_name, cache=False), events)
+        self.n_poll+=1
+        return events
 
 class Model:
 
     job_type=None
+    # used by preflight(), a subclass may override it, None skips the residue check
+    alphabet=SEQ_ALPHABET
 
     def __init__(self, job_type, api_key=None):
         Model.job_type=job_type
-        self.jm=JobManagement(api_key)
+        self.api_key=api_key
+        self._jm=None
         self.job_name=None
         self.batch_name=None
 
+    @property
+    def jm(self):
+        """JobManagement, created on first use, so preflight() works offline and without an API key"""
+        if self._jm is None:
+            self._jm=JobManagement(self.api_key)
+        return self._jm
+
+    @jm.setter
+    def jm(self, jm):
+        self._jm=jm
+
+    def check_name(self, name):
+        """Exit if a job or batch named name already exists, None is fine (a name is generated)"""
+        if name is not None and len(self.jm.get_jobs(job_name=name))>0:
+            print(f"Error> Job name {name} already exists!")
+            exit()
+
     def get_options(self, options = None):
         opt = self.__class__.default_opt.copy()
         if options is not None:
@@ -421,7 +1471,30 @@ class Model:
                 c_seen.add(x)
             exit()
 
-    def upload_templates(self, S_name, S_tmpl, batch_name=None):
+    def preflight(self, S_name, S_seq=None, S_tmpl=None, n_jobs=None):
+        """Validate a batch locally, before anything is uploaded or submitted.
+        Sequences are checked against self.alphabet, they must not be empty. Template files (format as in
+        upload_templates) must exist and be .cif files with atom records, they are checked in parallel
+        with n_jobs threads (defaults to READ_WORKERS), reading as little of each file as possible.
+        Raise an Exception listing the problems, if any.
+        """
+        problems=[]
+        if S_seq is not None:
+            for name,seq in zip(S_name, S_seq):
+                msg=check_sequence(seq, self.alphabet)
+                if msg: problems.append(f"{name}: {msg}")
+        S_fn=template_files(S_tmpl)
+        with ThreadPoolExecutor(max_workers=n_jobs or READ_WORKERS) as pool:
+            for fn,msg in zip(S_fn, pool.map(check_template, S_fn)):
+                if msg: problems.append(f"{fn}: {msg}")
+        if len(problems):
+            for x in problems[:20]:
+                print("    "+x)
+            if len(problems)>20:
+                print(f"    ... and {len(problems)-20} more")
+            raise Exception(f"Preflight failed with {len(problems)} problems, nothing was uploaded or submitted.")
+
+    def upload_templates(self, S_name, S_tmpl, batch_name=None, check=True, empty_first=True):
         """ S_name, list of sequence names
             S_tmpl, corresponding list of template file path. For one sequence name, there can be multiple
                 template files, which should be ";"-concatenated into one string
@@ -430,11 +1503,13 @@ class Model:
 
             If batch_name is None, there should only be one entry in S_name, all attachments
             are uploaded to the root folder.
+            check: check the files with check_template() first, skip it if preflight() did
+            empty_first: remove files already in the batch folder, False when uploading the chunks of one batch
 
-            return c_template, where keys are entries in S_name, values are list of uploaded file names
+            return c_template, a list with one entry per S_name, the list of uploaded file names
         """
         # Make sure size of S_name and S_tmpl are the same
-        if S_tmpl is None: return {}
+        if S_tmpl is None: return [[] for x in ([S_name] if type(S_name) is str else S_name)]
         if type(S_name) is str:
             S_name=[S_name]
             if type(S_tmpl) is not str:
@@ -455,34 +1530,17 @@ class Model:
             S_fn =list({ x.strip() for x in re.split(r';\s*', s) })
             S_tmpl[i]=S_fn
         S_unique=list({ x for X in S_tmpl for x in X if x!=''})
-        c_template={}
-        # check file format
-        for x in S_unique:
-            if not os.path.exists(x):
-                raise Exception(f"file {x} not found!")
-            fmt=guess_format(x)
-            if fmt!="cif":
-                raise Exception(f"file {x} is not a .cif file!")
-        # upload
-        if batch_name is not None:
-            c_map=self.jm.upload_batch(batch_name, S_unique)
-        else:
-            c_map={}
-            uploaded=set()
-            for x in set(S_unique):
-                fn, ext = os.path.splitext(os.path.basename(x))
-                name = fn+ext
-                i=2
-                while name in uploaded:
-                    name= fn+str(i)+ext
-                    i+=1
-                self.jm.upload_file(x, name)
-                c_map[x]=name
-                uploaded.add(name)
+        if check:
+            with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+                for x,msg in zip(S_unique, pool.map(check_template, S_unique)):
+                    if msg: raise Exception(f"file {x}: {msg}!")
+        # upload, into the root folder if batch_name is None
+        c_map=self.jm.upload_batch(batch_name, S_unique, empty_first=empty_first)
 
         c_template=[]
         for i,X in enumerate(S_tmpl):
-            c_template.append(sorted([c_map[x] for x in X if x in c_map]))
+            # identical local files are uploaded once, they map to the same remote name
+            c_template.append(sorted({c_map[x] for x in X if x in c_map}))
         return c_template
 
     def run(self, job_name=None, settings=None, output_folder=".", wait=True):
@@ -491,22 +1549,77 @@ class Model:
         self.batch_name=None
         assert(settings is not None)
         out=self.jm.submit_job(self.job_name, Model.job_type, settings)
+        self.jm.ledger.set_folder([self.job_name], output_folder)
         if not wait:
             self._notify(self.job_name, output_folder, False)
             return self.job_name
         self.jm.monitor(self.job_name, output_folder=output_folder)
+        index_structures(output_folder)
         self._notify(self.job_name, output_folder, True)
 
-    def batch(self, batch_name=None, settings=None, output_folder=".", wait=True):
-        """Run a batch of jobs"""
+    def batch(self, batch_name=None, settings=None, output_folder=".", wait=True, batch_size=None, dedup=None):
+        """Run a batch of jobs
+        batch_size: max. jobs per submission, larger batches are submitted in shards, defaults to BATCH_SIZE
+        dedup: serve jobs identical to completed earlier jobs from their results, defaults to DEDUP
+        """
         self.batch_name=batch_name or self.jm.generate_temp_job_name()
         self.job_name=None
         assert(settings is not None)
-        out=self.jm.submit_batch(self.batch_name, Model.job_type, settings)
+        if DEDUP if dedup is None else dedup:
+            settings=self.jm.dedup_batch(Model.job_type, settings, output_folder)
+            if len(settings["jobNames"])==0:
+                self.batch_name=None
+                print(f"All jobs are served from earlier results, outputs in {output_folder}.")
+                return None
+        out=self.jm.submit_batches(self.batch_name, Model.job_type, settings, batch_size=batch_size)
+        self.jm.ledger.set_batch_folder(out, output_folder)
         if not wait:
             self._notify(self.batch_name, output_folder, False)
             return self.batch_name
-        self.jm.monitor_batch(self.batch_name, output_folder)
+        # keep results.csv up to date as jobs finish, if the model can compile one
+        f=getattr(self.__class__, "results", None)
+        callback=(lambda S_job: f(output_folder, return_frame=False)) if callable(f) else None
+        self.jm.monitor_batch(self.batch_name, output_folder, callback=callback)
+        index_structures(output_folder)
+        self._notify(self.batch_name, output_folder, True)
+
+    def stream(self, batch_name=None, chunks=None, output_folder=".", wait=True, dedup=None, n_jobs=None):
+        """Run a batch given as an iterable of settings dicts (as in batch()), one per chunk of the input,
+        see JobManagement.submit_stream(). Chunks are consumed as they are submitted, so building one
+        (reading, preflight, template upload) overlaps with submitting the previous ones.
+        A chunk that fails preflight stops the stream, shards submitted before it are kept.
+        dedup: as in batch(), applied to each chunk
+        """
+        self.batch_name=batch_name or self.jm.generate_temp_job_name()
+        self.job_name=None
+        assert(chunks is not None)
+        dedup=DEDUP if dedup is None else dedup
+        c_seen=set()
+        def todo():
+            for settings in chunks:
+                # names must be unique across chunks, not only within one
+                S_dup=[x for x in settings["jobNames"] if x in c_seen]
+                if len(S_dup):
+                    raise Exception(f"{len(S_dup)} duplicate job names, e.g., {S_dup[0]}, shards submitted so far are kept")
+                c_seen.update(settings["jobNames"])
+                yield self.jm.dedup_batch(Model.job_type, settings, output_folder) if dedup else settings
+        try:
+            out=self.jm.submit_stream(self.batch_name, Model.job_type, todo(), n_jobs=n_jobs, output_folder=output_folder)
+        except Exception:
+            n=len(self.jm.c_shards.get(self.batch_name, []))
+            if n: print(f"WARNING> the input stopped after {n} shards were submitted, delete them with:\n    tmrdeljob {self.batch_name}")
+            raise
+        if len(out)==0:
+            self.batch_name=None
+            print(f"All jobs are served from earlier results, outputs in {output_folder}.")
+            return None
+        if not wait:
+            self._notify(self.batch_name, output_folder, False)
+            return self.batch_name
+        f=getattr(self.__class__, "results", None)
+        callback=(lambda S_job: f(output_folder, return_frame=False)) if callable(f) else None
+        self.jm.monitor_batch(self.batch_name, output_folder, callback=callback)
+        index_structures(output_folder)
         self._notify(self.batch_name, output_folder, True)
 
     def delete(self):
@@ -525,11 +1638,376 @@ class Model:
             s+=f"\nTo delete the batch:\n    tmrdeljob {name}"
             print(s)
 
-    def download_batch(self, batch_name, output_folder="."):
-        self.jm.get_batch_results(batch_name, output_folder)
+    def download_batch(self, batch_name, output_folder=".", n_jobs=None, force=False):
+        return self.jm.get_batch_results(batch_name, output_folder, n_jobs=n_jobs, force=force)
+
+    def download(self, job_name, output_folder=".", force=False):
+        return self.jm.get_results(job_name, output_folder, progress=True, force=force)
+
+def parallel(f, X, n_jobs, rate=None):
+    """Call f(x) for each x in X with n_jobs threads, and at most rate calls per second if rate is set.
+    Exceptions do not stop the other calls.
+
+    return dict mapping x that failed to the error message
+    """
+    failed={}
+    bucket=TokenBucket(rate, rate) if rate else None
+    def one(x):
+        if bucket is not None: bucket.acquire()
+        f(x)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        tasks={pool.submit(one, x): x for x in X}
+        for task in as_completed(tasks):
+            try:
+                task.result()
+            except Exception as e:
+                failed[tasks[task]]=str(e)
+    return failed
+
+def report(msg, failed):
+    """Print a summary line, followed by up to 10 failures"""
+    if len(failed):
+        msg+=f", {len(failed)} failed:"
+    print(msg)
+    for k,v in sorted(failed.items())[:10]:
+        print(f"    {k}: {v}")
+    if len(failed)>10:
+        print(f"    ... and {len(failed)-10} more")
+
+def shard_name(batch_name, i):
+    """Name of the i-th (0-based) shard of a batch, the first shard keeps the batch name"""
+    return batch_name if i==0 else f"{batch_name}__{i+1}"
+
+def is_shard(batch_name):
+    """Whether batch_name is a shard other than the first one"""
+    return re.search(r'__\d+$', batch_name) is not None
 
-    def download(self, job_name, output_folder="."):
-        self.jm.get_results(job_name, output_folder)
+def shard_base(batch_name):
+    """The batch name a shard belongs to"""
+    return re.sub(r'__\d+$', '', batch_name)
+
+def retry_after(value):
+    """Seconds to wait according to a Retry-After header (seconds or HTTP date), None if missing"""
+    if not value: return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp()-time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def index_structures(output_folder, path=None, n_jobs=None):
+    """Add structures of jobs downloaded into output_folder (per its manifest) to the structure index
+    at path (defaults to STRUCTURE_INDEX), only new or modified files are parsed.
+    n_jobs: number of parsing threads, defaults to READ_WORKERS
+
+    return number of files parsed, None if the index is disabled
+    """
+    path=STRUCTURE_INDEX if path is None else path
+    if not path or not os.path.isdir(output_folder): return None
+    jobs=Manifest.open(output_folder).jobs()
+    if len(jobs)==0: return 0
+    try:
+        return StructureIndex(path).update(output_folder, jobs, n_jobs=n_jobs or READ_WORKERS)
+    except Exception as e:
+        # the index is a convenience, never fail a download because of it
+        print(f"Warning: structure index not updated: {e}")
+        return None
+
+def job_folder(job_name):
+    """Name of the folder holding results of a job within an output folder"""
+    # when the sequence name appears before in other batches, Tamarind adds batch name as prefix
+    # we prefer to remove that
+    return re.sub(r'[^\-]+-', '', job_name)
+
+def created_names(t, batch_name, S_name, S_settings):
+    """Names the server gave to jobs of a batch whose requested names were in use
+    t: listing of the batch (get_shard_jobs()), S_name, S_settings: requested names and their settings
+    A job is matched by its requested name, the name prefixed by the batch name, or else by equal settings.
+
+    return dict requested name -> created name, jobs not found are left out
+    """
+    S_job=set(t.JobName)
+    # settings hash -> names in the listing
+    c_settings={}
+    if 'Settings' in t.columns:
+        for x,s in zip(t.JobName, t.Settings):
+            if isinstance(s, dict): c_settings.setdefault(settings_hash(s), []).append(x)
+    out={}
+    for x,s in zip(S_name, S_settings):
+        for y in [x, f"{batch_name}-{x}"]+c_settings.get(settings_hash(s), []):
+            if y in S_job:
+                out[x]=y
+                S_job.discard(y)
+                break
+    return out
+
+def plan_uploads(batch_name, S_local, S_hash, c_uploaded, uploaded):
+    """Remote names for upload_batch(), files with the same content share one remote file
+    S_local, S_hash: local files and their content hashes
+    c_uploaded: (folder, content hash) -> remote path uploaded before, entries for remote paths that are
+        about to be overwritten are removed
+    uploaded: remote paths already in the folder, names are suffixed to avoid them (the root folder is not listed,
+        so a file there with the same name is overwritten)
+
+    return (c_upload, c_remote, c_todo): local file -> remote path, content hash -> remote path,
+        remote path -> local file for files to be uploaded
+    """
+    uploaded=set(uploaded)
+    c_upload, c_remote, c_todo={}, {}, {}
+    # file name -> next suffix to try, when names collide
+    c_next={}
+    for x,h in zip(S_local, S_hash):
+        if h not in c_remote:
+            full_name=c_uploaded.get((batch_name, h))
+            if full_name is None or (batch_name is not None and full_name not in uploaded):
+                fn, ext = os.path.splitext(os.path.basename(x))
+                name = fn+ext
+                i=c_next.get(name, 2)
+                while os.path.join(batch_name or "", name) in uploaded:
+                    name= fn+str(i)+ext
+                    i+=1
+                c_next[fn+ext]=i
+                full_name=os.path.join(batch_name or "", name)
+                uploaded.add(full_name)
+                c_todo[full_name]=x
+                # the remote file gets new content, it no longer holds what was uploaded there before
+                for k in [k for k,v in c_uploaded.items() if v==full_name and k[0]==batch_name]:
+                    del c_uploaded[k]
+            c_remote[h]=full_name
+        c_upload[x]=c_remote[h]
+    return c_upload, c_remote, c_todo
+
+def file_hash(fn):
+    """SHA-256 of a file's content, the file is read in CHUNK_SIZE blocks"""
+    h=hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def page_jobs(jobs_json):
+    """Job records in one page returned by the jobs endpoint"""
+    if 'jobs' in jobs_json:
+        return jobs_json['jobs']
+    elif '0' in jobs_json:
+        return [jobs_json['0']]
+    return []
+
+def job_params(job_name=None, expand_batch=False, organization=False):
+    """Query parameters of the jobs endpoint"""
+    params={}
+    if job_name is not None:
+        params['jobName']=job_name
+    if organization:
+        params['organization']=True
+    if expand_batch:
+        params['includeSubjobs']="true"
+    return params
+
+def job_filter(job_type=None, status=None, prefix=None, created_after=None):
+    """Return a function that filters a list of job records, see iter_jobs"""
+    if isinstance(status, str): status=[status]
+    if created_after is not None: created_after=pd.to_datetime(created_after, utc=True)
+    def keep(out):
+        if job_type is not None:
+            out=[r for r in out if (r.get('Settings') if r.get('Type')=='batch' else r.get('Type'))==job_type]
+        if status is not None:
+            out=[r for r in out if r.get('JobStatus') in status]
+        if prefix is not None:
+            out=[r for r in out if str(r.get('JobName', '')).startswith(prefix)]
+        if created_after is not None and len(out):
+            t=pd.to_datetime(pd.Series([r.get('Created') for r in out]), utc=True, errors='coerce')
+            out=[r for r,ok in zip(out, (t>created_after).tolist()) if ok]
+        return out
+    return keep
+
+def jobs_frame(out, job_type=None):
+    """Convert job records returned by the jobs endpoint into the dataframe returned by get_jobs"""
+    if len(out)==0:
+        jobs_df=pd.DataFrame([], columns=['Score','JobName','JobStatus','Type','Settings','Created','Model','Batch'])
+        return jobs_df
+    else:
+        jobs_df=pd.DataFrame(out)
+        is_batch=jobs_df.Type=='batch'
+        jobs_df['Model']=jobs_df.Settings.where(is_batch, jobs_df.Type)
+    if job_type:
+        jobs_df=jobs_df[jobs_df.Model==job_type].copy()
+        is_batch=jobs_df.Type=='batch'
+    if 'Batch' not in jobs_df.columns:
+        jobs_df['Batch']=jobs_df.JobName.where(is_batch, None)
+    else: # expanded, let's remove the batch entry
+        jobs_df=jobs_df[~is_batch].copy()
+    return jobs_df
+
+def batch_jobs_frame(out):
+    """Convert job records of a batch into the dataframe returned by get_batch_jobs"""
+    if len(out)==0:
+        return pd.DataFrame([], columns=['Score','JobName','JobStatus','Type','Settings','Created','Batch'])
+    return pd.DataFrame(out)
+
+def save_stream(response, save_path, progress=False, append=False):
+    """Write a streamed requests response into save_path chunk by chunk, memory use is bounded by CHUNK_SIZE
+    progress: True to show a byte progress bar, or a callable that receives the number of bytes written
+    append: append to an existing file, used to resume a partial download
+    """
+    pg=None
+    if progress is True:
+        total=int(response.headers.get('Content-Length', 0)) or None
+        pg=tqdm.tqdm(total=total, unit='B', unit_scale=True, position=0)
+        progress=pg.update
+    with open(save_path, 'ab' if append else 'wb') as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+            if progress: progress(len(chunk))
+    if pg is not None: pg.close()
+
+def aggregate_results(output_folder, metrics_file, sort_by, ascending=True, path_col="Pdb Path", src_col=None, fix=None, n_jobs=None,
+        incremental=True, model=None, fmt=None, dataset=None, return_frame=True):
+    """Merge the metrics files of all job folders under output_folder into output_folder/results.csv.
+    This is the engine behind the results() method of models.
+
+    metrics_file: name of the metrics file within each job folder, e.g., metrics.csv
+    sort_by, ascending: rows are sorted by job name, then by sort_by within each job
+    path_col: output column of structure file paths, prefixed with the job folder
+    src_col: column of file names relative to the job folder, defaults to path_col
+    fix: optional function applied to the path_col Series, e.g., to patch a known naming bug
+    n_jobs: number of threads reading metrics files, defaults to READ_WORKERS
+    incremental: only parse metrics files that are new or modified since the last call, as recorded in
+        RESULTS_STATE. If False, results.csv is rebuilt from scratch.
+    return_frame: False to not read the merged table back, e.g., in a callback run after every group of
+        downloads, then rows of new jobs are appended to results.csv in the order jobs landed, and None
+        is returned. A call with return_frame=True sorts results.csv again (rewriting it if needed).
+    model: model name, stored in the "model" column of parquet/feather output
+    fmt: csv, parquet or feather, defaults to RESULTS_FORMAT. parquet/feather output has typed columns,
+        plus "batch" (output folder name) and "model" columns, so many batches can be loaded as one
+        dataset with load_results()
+    dataset: defaults to RESULTS_DATASET, if set, parquet/feather results are also written into
+        dataset/model=[model]/batch=[batch]/
+
+    return the merged dataframe, None if no metrics file is found or return_frame is False
+    """
+    if not os.path.exists(output_folder):
+        return
+    fmt=fmt or RESULTS_FORMAT
+    dataset=dataset or RESULTS_DATASET
+    # job -> modification time of its metrics file
+    c_mtime={}
+    with os.scandir(output_folder) as it:
+        for x in it:
+            if not x.is_dir(): continue
+            try:
+                c_mtime[x.name]=os.stat(os.path.join(x.path, metrics_file)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+    fn_out=os.path.join(output_folder, "results."+fmt)
+    fn_state=os.path.join(output_folder, RESULTS_STATE)
+    c_old={}
+    # False if rows were appended after results.csv was last sorted
+    is_sorted=True
+    if incremental and os.path.exists(fn_out) and os.path.exists(fn_state):
+        with open(fn_state) as f:
+            state=json.load(f)
+        if state.get('metrics_file')==metrics_file and state.get('format', 'csv')==fmt:
+            c_old=state['jobs']
+            is_sorted=state.get('sorted', True)
+    def save_state():
+        with open(fn_state, 'w') as f:
+            json.dump({'metrics_file': metrics_file, 'format': fmt, 'jobs': c_mtime, 'sorted': is_sorted}, f)
+    def sort(t):
+        return t.sort_values(['name', sort_by], ascending=[True, ascending], kind='mergesort', ignore_index=True)
+    S_new=[x for x,m in c_mtime.items() if c_old.get(x)!=m]
+    # modified or removed jobs
+    S_drop={x for x,m in c_old.items() if c_mtime.get(x)!=m}
+    if len(S_new)==0 and len(S_drop)==0:
+        if not return_frame or len(c_old)==0:
+            return None
+        t=read_table(fn_out)
+        if not is_sorted:
+            t=sort(t)
+            write_table(t, fn_out)
+            is_sorted=True
+            save_state()
+        return t
+    def read(job):
+        return pd.read_csv(os.path.join(output_folder, job, metrics_file))
+    with ThreadPoolExecutor(max_workers=n_jobs or READ_WORKERS) as pool:
+        T=list(pool.map(read, S_new))
+    t=None
+    if len(T):
+        t=pd.concat(T, ignore_index=True)
+        t['name']=pd.Series(S_new).repeat([len(x) for x in T]).values
+        t=sort(t)
+        t[path_col]=os.path.join(output_folder, "")+t['name']+os.sep+t[src_col or path_col].astype(str)
+        if fix is not None:
+            t[path_col]=fix(t[path_col])
+        if fmt!="csv":
+            t['batch']=os.path.basename(os.path.abspath(output_folder))
+            t['model']=model
+            t=t.convert_dtypes()
+    if not return_frame and fmt=="csv" and len(c_old) and len(S_drop)==0 and list(pd.read_csv(fn_out, nrows=0).columns)==list(t.columns):
+        # only new jobs, append their rows, results.csv is sorted again by the next call returning the frame
+        t.to_csv(fn_out, mode='a', header=False, index=False)
+        is_sorted=False
+        t=None
+    else:
+        if len(c_old):
+            t_old=read_table(fn_out)
+            t=pd.concat([t_old[~t_old.name.isin(S_drop)], t], ignore_index=True)
+            t=sort(t)
+        if t is None or len(t)==0:
+            for fn in (fn_out, fn_state):
+                if os.path.exists(fn): os.remove(fn)
+            return None
+        write_table(t, fn_out)
+        if dataset is not None and fmt!="csv":
+            # partition columns are encoded in the path
+            fd=os.path.join(dataset, f"model={model}", f"batch={t['batch'].iloc[0]}")
+            os.makedirs(fd, exist_ok=True)
+            write_table(t.drop(columns=['batch','model']), os.path.join(fd, "part-0."+fmt))
+        is_sorted=True
+    save_state()
+    return t if return_frame else None
+
+def read_table(fn, columns=None):
+    """Read a results file, the format is given by the file extension: .csv, .parquet or .feather"""
+    ext=os.path.splitext(fn)[1]
+    if ext==".parquet":
+        return pd.read_parquet(fn, columns=columns)
+    if ext==".feather":
+        return pd.read_feather(fn, columns=columns)
+    return pd.read_csv(fn, usecols=columns, dtype={'name':str})
+
+def write_table(t, fn):
+    """Write a results file, the format is given by the file extension: .csv, .parquet or .feather"""
+    ext=os.path.splitext(fn)[1]
+    if ext==".parquet":
+        t.to_parquet(fn, index=False)
+    elif ext==".feather":
+        t.reset_index(drop=True).to_feather(fn)
+    else:
+        t.to_csv(fn, index=False)
+
+def load_results(paths, columns=None, filters=None):
+    """Load parquet/feather results of many batches as one dataframe, requires pyarrow.
+    paths: a results file, a dataset folder written with RESULTS_DATASET (model and batch become columns),
+        or a list of results files
+    columns: only read these columns
+    filters: pushed down to the file reader, so row groups that cannot match are skipped,
+        e.g., [("model", "==", "boltz"), ("iptm", ">", 0.8)], or a pyarrow.dataset expression
+
+    E.g., load_results("dataset", columns=["batch", "name", "iptm"], filters=[("iptm", ">", 0.8)])
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    S=[paths] if isinstance(paths, str) else list(paths)
+    fmt="feather" if all(x.endswith(".feather") for x in S) else "parquet"
+    d=ds.dataset(S[0] if len(S)==1 else S, format=fmt, partitioning="hive")
+    if isinstance(filters, list):
+        filters=pq.filters_to_expression(filters)
+    return d.to_table(columns=columns, filter=filters).to_pandas()
 
 def parse_json(json_string):
     try:
@@ -542,26 +2020,119 @@ def parse_json(json_string):
         print(f"Problematic part: {e.doc[e.pos-20:e.pos+20]}")
         sys.exit(1)
 
+def is_fasta(fn):
+    """Whether an input file is FASTA, by its extension"""
+    return os.path.splitext(fn[:-3] if fn.endswith(".gz") else fn)[1].lower() in FASTA_EXT
+
+def fasta_chunks(fn, chunksize=None):
+    """Read a FASTA file (may be .gz) line by line, yield dataframes with columns name (first word of the header)
+    and sequence, of at most chunksize records, or one dataframe with all records if chunksize is None
+    """
+    S_name,S_seq=[],[]
+    name,seq=None,[]
+    n_yield=0
+    with (gzip.open(fn, 'rt') if fn.endswith(".gz") else open(fn)) as f:
+        for line in f:
+            line=line.strip()
+            if line.startswith(">"):
+                if name is not None:
+                    S_name.append(name)
+                    S_seq.append("".join(seq))
+                    if chunksize and len(S_name)>=chunksize:
+                        yield pd.DataFrame({'name':S_name, 'sequence':S_seq})
+                        n_yield+=1
+                        S_name,S_seq=[],[]
+                name=(line[1:].split() or [""])[0]
+                seq=[]
+            elif line!="" and not line.startswith(";") and name is not None:
+                seq.append(line)
+    if name is not None:
+        S_name.append(name)
+        S_seq.append("".join(seq))
+    if len(S_name) or n_yield==0:
+        yield pd.DataFrame({'name':S_name, 'sequence':S_seq})
+
+def read_input(fn, chunksize=None, usecols=None):
+    """Read a model input file: .csv, or FASTA (see is_fasta()) giving columns name and sequence.
+    chunksize: if set, return an iterator of dataframes of at most chunksize rows instead, the file is read
+        as chunks are consumed, so huge inputs are never loaded at once
+    usecols: only read these columns of a .csv file
+    """
+    if is_fasta(fn):
+        chunks=fasta_chunks(fn, chunksize)
+        return chunks if chunksize else next(chunks)
+    return pd.read_csv(fn, chunksize=chunksize, usecols=usecols)
+
+def input_columns(fn):
+    """Column names of a model input file, only the header of a .csv file is read"""
+    if is_fasta(fn): return ['name', 'sequence']
+    return pd.read_csv(fn, nrows=0).columns.tolist()
+
+def require_columns(fn, S_col):
+    """Exit if the model input file misses any of the columns S_col"""
+    S_miss=[x for x in S_col if x not in input_columns(fn)]
+    if len(S_miss):
+        print(f"ERROR> missing required column {', '.join(S_miss)}.")
+        exit()
+
 def guess_format(fn):
-    """Guess if a file is PDB or CIF"""
+    """Guess if a file is PDB or CIF, only the first SNIFF_BYTES are read if the extension does not tell"""
     ext=os.path.splitext(fn)[1]
-    if ext in ('.gz'):
+    if ext=='.gz':
         #ColabFold cannot use .gz
         #ext=os.path.splitext(fn[:-3])[1]
         return "gz"
     if ext in ('.pdb','.pdb1'): return "pdb"
-    if ext in ('.cif'): return "cif"
+    if ext=='.cif': return "cif"
     with open(fn, mode='rb') as f:
-        s=f.read()
+        s=f.read(SNIFF_BYTES)
     s=s.decode("utf-8", 'ignore')
     S=s.splitlines()
     pat_loop=re.compile(r'^(loop_|data_|_atom)')
-    pat_key=re.compile(r'^(HEADER|TITLE|KEYWDS|REMARK|MODEL|END) ')
+    pat_key=re.compile(r'^(HEADER|TITLE|KEYWDS|REMARK|MODEL|CRYST1|ATOM  |HETATM|END) ')
     for s in S:
         if pat_key.search(s): return 'pdb'
         if pat_loop.search(s): return "cif"
     return ""
 
+def check_cif(fn):
+    """Problem with a .cif file, None if it looks fine.
+    Lines are streamed until the first _atom_site record, so usually only the header is read.
+    """
+    with open(fn, 'rb') as f:
+        first=True
+        for line in f:
+            s=line.strip()
+            if first and s!=b'' and not s.startswith(b'#'):
+                if not s.startswith(b'data_'): return "not a .cif file, it does not start with data_"
+                first=False
+            if s.startswith(b'_atom_site.'): return None
+    return "empty file" if first else "no _atom_site records in .cif file"
+
+def check_template(fn):
+    """Problem with a template file, None if it is a valid .cif file"""
+    if not os.path.exists(fn): return "file not found"
+    if guess_format(fn)!="cif": return "not a .cif file"
+    return check_cif(fn)
+
+def template_files(S_tmpl):
+    """Unique file names in templates given as in Model.upload_templates()"""
+    if S_tmpl is None: return []
+    if type(S_tmpl) is str: S_tmpl=[S_tmpl]
+    return sorted({x.strip() for s in S_tmpl if pd.notnull(s) for x in re.split(r';\s*', s) if x.strip()!=''})
+
+def check_sequence(seq, alphabet=None):
+    """Problem with a sequence, None if fine. Chains are separated by ":"
+    alphabet: allowed residue letters (case-insensitive), None means anything
+    """
+    if not isinstance(seq, str) or seq.strip()=="": return "empty sequence"
+    S=[re.sub(r'\s+', '', x) for x in seq.split(":")]
+    if "" in S: return "empty chain"
+    if alphabet:
+        bad=set("".join(S).upper())-set(alphabet.upper())
+        if len(bad): return "unexpected residues: "+"".join(sorted(bad))
+    return None
+
 def main():
     args = parse_arguments()
     settings_dict = parse_json(args.setting)
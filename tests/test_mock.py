@@ -0,0 +1,160 @@
+"""Submit, monitor, download and delete batches against tamarind.mockserver"""
+import os, time, asyncio
+import pytest
+import tamarind.tamarind as tmr
+from tamarind.tamarind import JobManagement, Manifest
+from tamarind.mockserver import MockServer
+
+@pytest.fixture
+def srv(monkeypatch):
+    # fast polls, no host-wide rate limit file, no ledger
+    for k,v in dict(RATE_LIMIT=0, LEDGER="", CACHE_TTL=0, MONITOR_INTERVAL=0.05, MIN_INTERVAL=0.01, POLL_BUDGET=6000).items():
+        monkeypatch.setattr(tmr, k, v)
+    with MockServer(queue_time=(0, 0.05), run_time=(0.05, 0.2)) as srv:
+        yield srv
+
+def new_jm(srv):
+    return JobManagement(api_key="mock", base_url=srv.base_url)
+
+def submit(jm, batch_name, n, batch_size):
+    settings={"settings": [{"sequence": "ACDEFGHIK"}]*n, "jobNames": [f"s{i}" for i in range(n)]}
+    return jm.submit_batches(batch_name, "alphafold", settings, batch_size=batch_size)
+
+def test_submit_shards(srv):
+    jm=new_jm(srv)
+    assert submit(jm, "b1", 10, 4)==["b1", "b1__2", "b1__3"]
+    # another client finds the shards from the API
+    jm=new_jm(srv)
+    assert jm.batch_shards("b1")==["b1", "b1__2", "b1__3"]
+    assert sorted(jm.get_batch_jobs("b1").JobName)==sorted(f"s{i}" for i in range(10))
+    # a submission is never replayed, a duplicate batch is an error
+    with pytest.raises(Exception, match="cannot be created"):
+        submit(jm, "b1", 2, 4)
+
+def test_monitor_sharded_batch(srv, tmp_path):
+    jm=new_jm(srv)
+    submit(jm, "b2", 10, 4)
+    landed=[]
+    failed=new_jm(srv).monitor_batch("b2", str(tmp_path), callback=landed.extend)
+    assert failed=={}
+    assert sorted(landed)==sorted(f"s{i}" for i in range(10))
+    manifest=Manifest.open(str(tmp_path))
+    for i in range(10):
+        assert manifest.is_done(f"s{i}")
+        assert os.path.exists(os.path.join(tmp_path, manifest.get(f"s{i}")["folder"], "metrics.csv"))
+    # nothing is downloaded twice
+    n=srv.calls["download"]
+    assert jm.download_jobs([f"s{i}" for i in range(10)], str(tmp_path))=={}
+    assert srv.calls["download"]==n
+
+def test_monitor_stops_on_error(srv, tmp_path, monkeypatch):
+    jm=new_jm(srv)
+    submit(jm, "b5", 40, 100)
+    time.sleep(0.5)
+    # slow downloads, the second poll fails while most jobs are still queued
+    get_results, get_batch_jobs=jm.get_results, jm.get_batch_jobs
+    monkeypatch.setattr(jm, "get_results", lambda *a, **kw: time.sleep(0.05) or get_results(*a, **kw))
+    polls=[]
+    def poll(batch_name):
+        polls.append(batch_name)
+        if len(polls)>1: raise KeyboardInterrupt
+        t=get_batch_jobs(batch_name).copy()
+        t.loc[0, "JobStatus"]="Running"
+        return t
+    monkeypatch.setattr(jm, "get_batch_jobs", poll)
+    with pytest.raises(KeyboardInterrupt):
+        jm.monitor_batch("b5", str(tmp_path), n_jobs=1)
+    assert srv.calls["download"]<10
+
+def test_resume_download(srv, tmp_path):
+    jm=new_jm(srv)
+    jm.submit_job("j1", "alphafold", {"sequence": "ACDEFGHIK"})
+    jm.monitor("j1", str(tmp_path/"full"))
+    url=jm._request("POST", "result", json={"jobName": "j1"}).text.replace('"', '')
+    r=jm.session.get(url)
+    # an interrupted download left half of the archive
+    fout=tmp_path/"part"/tmr.job_folder("j1")
+    os.makedirs(fout)
+    (fout/"result.zip").write_bytes(r.content[:len(r.content)//2])
+    Manifest.open(str(tmp_path/"part")).update("j1", folder=tmr.job_folder("j1"), etag=r.headers["ETag"], completed=None)
+    assert jm.get_results("j1", str(tmp_path/"part")).startswith("Downloaded")
+    assert not os.path.exists(fout/"result.zip")
+    for fn in os.listdir(tmp_path/"full"/tmr.job_folder("j1")):
+        assert (fout/fn).read_bytes()==(tmp_path/"full"/tmr.job_folder("j1")/fn).read_bytes()
+
+def test_delete(srv):
+    jm=new_jm(srv)
+    submit(jm, "b3", 10, 4)
+    submit(jm, "b4", 3, 4)
+    jm.upload_file(__file__, "t.py", folder="b3")
+    # shards are found in the listing, no lookups of b3__2, b3__3, ...
+    jm=new_jm(srv)
+    listing=jm.get_jobs().JobName.tolist()
+    assert jm.delete_batches(["b3"], listing=listing)=={}
+    assert sorted(jm.get_jobs().JobName)==["b4"]
+    assert jm.get_files(folder="b3")==[]
+    assert jm.delete_all_jobs()
+    assert len(srv.state.jobs)==0
+
+def test_upload_root_same_name(srv, tmp_path):
+    jm=new_jm(srv)
+    for d,text in (("A", "data_a"), ("B", "data_b")):
+        os.makedirs(tmp_path/d)
+        (tmp_path/d/"t.cif").write_text(text)
+    a, b=str(tmp_path/"A"/"t.cif"), str(tmp_path/"B"/"t.cif")
+    assert jm.upload_batch(None, [a])=={a: "t.cif"}
+    jm.upload_batch(None, [b])
+    n=srv.calls["upload"]
+    # B replaced the remote t.cif, so A has to be uploaded again
+    jm.upload_batch(None, [a])
+    assert srv.calls["upload"]==n+1
+    assert len(set(jm.c_uploaded.values()))==len(jm.c_uploaded)
+
+def test_async_upload(srv, tmp_path):
+    aio=pytest.importorskip("tamarind.aio")
+    for d in ("A", "B"):
+        os.makedirs(tmp_path/d)
+        (tmp_path/d/"t.cif").write_text("data_a")
+    a, b=str(tmp_path/"A"/"t.cif"), str(tmp_path/"B"/"t.cif")
+    async def main():
+        async with aio.AsyncJobManagement("mock", base_url=srv.base_url) as jm:
+            root=await jm.upload_batch(None, [a, b])
+            folder=await jm.upload_batch("bx", [a, b])
+            return root, folder
+    root, folder=asyncio.run(main())
+    # identical content under two paths is uploaded once
+    assert root=={a: "t.cif", b: "t.cif"} and folder=={a: "bx/t.cif", b: "bx/t.cif"}
+    assert srv.calls["upload"]==2
+
+def ledger_jm(srv, tmp_path):
+    return JobManagement(api_key="mock", base_url=srv.base_url, ledger=str(tmp_path/"ledger.db"))
+
+def one_job(settings):
+    return {"settings": [settings], "jobNames": ["s0"]}
+
+def test_dedup_reused_name(srv, tmp_path):
+    jm=ledger_jm(srv, tmp_path)
+    a, c={"sequence": "AAA"}, {"sequence": "CCC"}
+    jm.submit_batch("b1", "alphafold", one_job(a))
+    assert jm.monitor_batch("b1", str(tmp_path/"o1"))=={}
+    # s0 is in use, the server names the new job b2-s0
+    jm.submit_batch("b2", "alphafold", one_job(c))
+    assert jm.dedup_batch("alphafold", one_job(c), str(tmp_path/"o3"))==one_job(c)
+    assert jm.monitor_batch("b2", str(tmp_path/"o2"))=={}
+    # each settings are served from their own job
+    for x,name in ((a, "s0"), (c, "b2-s0")):
+        out=tmp_path/f"o{x['sequence']}"
+        assert jm.dedup_batch("alphafold", one_job(x), str(out))["jobNames"]==[]
+        assert os.path.exists(out/"s0"/f"{name}_model_1.pdb")
+
+def test_dedup_deleted_job(srv, tmp_path):
+    jm=ledger_jm(srv, tmp_path)
+    jm.submit_batch("b3", "alphafold", one_job({"sequence": "AAA"}))
+    assert jm.monitor_batch("b3", str(tmp_path/"o1"))=={}
+    assert jm.delete_batch("b3")=={}
+    assert jm.ledger.records(expand_batch=True)==[]
+    # results downloaded before are still served
+    n=srv.calls["download"]
+    assert jm.dedup_batch("alphafold", one_job({"sequence": "AAA"}), str(tmp_path/"o2"))["jobNames"]==[]
+    assert os.path.exists(tmp_path/"o2"/"s0"/"metrics.csv")
+    assert srv.calls["download"]==n